@@ -1,5 +1,9 @@
 import os
+import json
 import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 import math as m
 import numpy as np
 import scipy.signal
@@ -10,16 +14,28 @@ from scipy.ndimage import gaussian_filter
 
 from global_var import *
 import tools as tl
-from nanoparticle import NanoParticle
+from nanoparticle import NPTable
+from frame_cache import FrameCache
+from correlation import Correlator
 
 
 class Core(object):
-    def __init__(self, folder, file):
+    def __init__(self, folder, file, mmap=False, cache=False, dtype='float64'):
         self.folder = folder
         self.file = file
+        self.mmap = mmap
+        self.cache = cache
+        self.dtype = DTYPE_POLICIES[dtype]
+
+        # integer raw data are stored as counts
+        if np.issubdtype(self.dtype['raw'], np.integer):
+            self._raw_scale = 1 / PX_DEPTH
+        else:
+            self._raw_scale = 1
 
         self._data_raw = None
-        self._data_mask = None
+        self._source_file = None
+        self._mask_points = None
         self._data_corr = None
         self._data_diff_std = None
         self._data_corr_std = None
@@ -28,6 +44,10 @@ class Core(object):
         self._mask_ommit = None
         self._mask_defects = None
 
+        self._acc_local = None
+        self._acc_base = None
+        self._acc_chunk = None
+
         self._time_info = None
         self._ref_frame = 0
         self._range = {
@@ -44,6 +64,7 @@ class Core(object):
 
         self.k = 1
         self.downsample_k = 1
+        self.downsample_mode = DOWNSAMPLE_MODE
         self.type = 'diff'
         self._f = int()
         self.fourier_level = 30
@@ -56,8 +77,7 @@ class Core(object):
         # np_counting
         self.stack_frames = []
         self.dist = 4
-        self.np_container = []
-        self.nps_in_frame = []
+        self.np_container = NPTable()
         self.show_nps = False
 
         self.graphs = dict()
@@ -67,6 +87,16 @@ class Core(object):
 
         self.idea3d = None
         self.autocorrelation_max = None
+        self._data_avg = None
+
+        self.frame_cache = FrameCache(FRAME_CACHE_BYTES)
+        self._frame_state = None
+        # bumped on every change of the arrays, a part of the keys of the cache
+        self._frame_generation = 0
+        self._frame_state_lock = threading.Lock()
+        self._prefetch_pool = None
+        self._prefetch_pending = dict()
+        self._prefetch_lock = threading.Lock()
 
         time0 = time.time()
         self._load_data()
@@ -87,10 +117,15 @@ class Core(object):
             self._data_raw = self._data_raw[SMIN: SMAX, LMIN: LMAX, :]
         else:
             self._data_raw = self._data_raw[LMIN: LMAX, SMIN: SMAX, :]
+        self.drop_accumulator()
+
+        self.print('intensity: {}'.format(np.average(np.sum(self._data_raw, axis=(0, 1))) * self._raw_scale))
+        self.print('average px: {}'.format(np.average(self._data_raw) * self._raw_scale))
+        self.print('average px x area: {}'.format(np.average(self._data_raw) * self._raw_scale * self.area))
 
-        self.print('intensity: {}'.format(np.average(np.sum(self._data_raw, axis=(0, 1)))))
-        self.print('average px: {}'.format(np.average(self._data_raw)))
-        self.print('average px x area: {}'.format(np.average(self._data_raw) * self.area))
+    def transpose(self):
+        self._data_raw = np.swapaxes(self._data_raw, 0, 1)
+        self.drop_accumulator()
 
     def _load_stats(self):
         suffix = '.tsv'
@@ -108,21 +143,198 @@ class Core(object):
     def _load_video(self):
         if FOLDER_SAVED in self.folder:
             self.print(self.folder)
-            video = np.load(self.folder + self.file + '.npy')
+            self._source_file = self.folder + self.file + '.npy'
+            video = np.load(self._source_file, mmap_mode='r' if self.mmap else None)
             self.folder = self.folder.replace(FOLDER_SAVED, '')
             self.print(self.folder)
 
+            # exported frames are not raw counts, they can be stored as floats only
+            self._raw_scale = 1
+            if video.dtype != self.dtype['work']:
+                video = tl.convert(video, self.dtype['work'], 1, CHUNK_FRAMES)
+
+            return video
+
+        self._source_file = self.folder + self.file + '.bin'
+
+        video = self._load_cache()
+        if video is not None:
             return video
 
-        with open(self.folder + self.file + '.bin', mode='rb') as fid:
-            video = np.fromfile(fid, dtype=np.float64)
-            fid.close()
+        shape = (self.__video_stats[0], self.__video_stats[1], self.__video_stats[2])
+
+        if self.mmap:
+            # no copy, the frames are paged in from the disk on demand
+            video = np.memmap(self.folder + self.file + '.bin', dtype=np.float64, mode='r', shape=shape, order='F')
+
+        else:
+            with open(self.folder + self.file + '.bin', mode='rb') as fid:
+                video = np.fromfile(fid, dtype=np.float64)
+                fid.close()
+
+            video = np.reshape(video, shape, order='F')
+
+        video = np.swapaxes(video, 0, 1)
+
+        if video.dtype != self.dtype['raw']:
+            if self.mmap:
+                self.print('Data converted to {} in memory, use the frame cache to map them.'.format(
+                    self.dtype['raw']))
+            video = tl.convert(video, self.dtype['raw'], 1 / self._raw_scale, CHUNK_FRAMES)
+
+        if self.cache:
+            self.make_cache(video)
+            return self._load_cache()
+
+        return video
 
-        video = np.reshape(video, (self.__video_stats[0],
-                                   self.__video_stats[1],
-                                   self.__video_stats[2]), order='F')
+    def _cache_file(self):
+        return self.folder + FOLDER_CACHE + '/' + self.file + '_frames_' + self.dtype['raw']
 
-        return np.swapaxes(video, 0, 1)
+    def _cache_header(self):
+        stat = os.stat(self.folder + self.file + '.bin')
+
+        return {
+            'source': self.file + '.bin',
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'shape': [self.__video_stats[1], self.__video_stats[0], self.__video_stats[2]],
+            'dtype': self.dtype['raw']
+        }
+
+    def _load_cache(self):
+        file_name = self._cache_file()
+        try:
+            with open(file_name + '.json', 'r') as fid:
+                header = json.load(fid)
+
+        except FileNotFoundError:
+            return None
+
+        if header != self._cache_header():
+            self.print('Frame cache does not match the raw file, it is not used.')
+            return None
+
+        self.print('Frame cache loaded')
+        return tl.load_frame_major(file_name + '.npy', self.mmap)
+
+    def make_cache(self, video=None):
+        if video is None:
+            video = self._data_raw
+
+        if not os.path.isdir(self.folder + FOLDER_CACHE):
+            os.mkdir(self.folder + FOLDER_CACHE)
+
+        file_name = self._cache_file()
+        tl.save_frame_major(file_name + '.npy', video, CHUNK_FRAMES)
+
+        with open(file_name + '.json', 'w') as fid:
+            json.dump(self._cache_header(), fid)
+
+        self.print('Frame cache created')
+
+    def _correlation_key(self):
+        # hash of everything the correlation depends on, the filters are hashed by tl.function_key, the filters
+        # from the gui bind their parameters as default arguments, so equal settings give equal keys
+        stat = os.stat(self._source_file)
+        h = hashlib.sha1()
+        h.update(json.dumps({
+            'source': os.path.basename(self._source_file),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'shape': self.shape,
+            'downsample': self.downsample_k,
+            'downsample_mode': self.downsample_mode,
+            'dtype': self.dtype,
+            'k': self.k,
+            'postprocessing': self.postprocessing,
+            'filters': [
+                [name, tl.function_key(fn)]
+                for name, fn in self.postprocessing_filters.items()
+            ] if self.postprocessing else None
+        }, sort_keys=True).encode())
+
+        # samples of the raw data tell crops and transpositions apart
+        for f in [0, len(self) // 2, len(self) - 1]:
+            h.update(np.ascontiguousarray(self._data_raw[:, :, f]).tobytes())
+
+        for array in [self.idea3d, self._mask_fourier if self.postprocessing else None]:
+            h.update(b'-' if array is None else np.ascontiguousarray(array).tobytes())
+
+        if self._mask_defects is None:
+            h.update(b'-')
+        else:
+            for start in range(0, self._mask_defects.shape[2], CHUNK_FRAMES):
+                h.update(np.ascontiguousarray(self._mask_defects[:, :, start: start + CHUNK_FRAMES]).tobytes())
+
+        return h.hexdigest()[:16]
+
+    def _correlation_file(self, key):
+        return self.folder + FOLDER_CACHE + '/' + self.file + '_corr_' + key
+
+    def _load_correlation(self, key):
+        file_name = self._correlation_file(key)
+        try:
+            with open(file_name + '.json', 'r') as fid:
+                header = json.load(fid)
+
+        except FileNotFoundError:
+            return False
+
+        self._data_corr = tl.load_frame_major(file_name + '.npy', mmap=True)
+        self._data_corr_std = np.array(header['corr_std'])
+        self._data_diff_std = header['diff_std']
+        self._range['corr'] = header['range']
+
+        # the modification time orders the eviction
+        os.utime(file_name + '.npy')
+        self.print('Correlation loaded from the cache')
+        return True
+
+    def _save_correlation(self, key):
+        if not os.path.isdir(self.folder + FOLDER_CACHE):
+            os.mkdir(self.folder + FOLDER_CACHE)
+
+        file_name = self._correlation_file(key)
+        tl.save_frame_major(file_name + '.npy', self._data_corr, CHUNK_FRAMES)
+
+        with open(file_name + '.json', 'w') as fid:
+            json.dump({
+                'corr_std': [float(s) for s in self._data_corr_std],
+                'diff_std': [float(s) for s in self._data_diff_std],
+                'range': [float(r) for r in self._range['corr']]
+            }, fid)
+
+        self._evict_cache()
+
+    def _evict_cache(self):
+        # the least recently used correlations and downsampled videos are removed until the cache fits
+        # CORRELATION_CACHE_BYTES
+        folder = self.folder + FOLDER_CACHE + '/'
+        files = sorted(
+            [
+                folder + name for name in os.listdir(folder)
+                if ('_corr_' in name or '_downsampled_' in name) and name.endswith('.npy')
+            ],
+            key=os.path.getmtime
+        )
+        size = sum(os.path.getsize(file) for file in files)
+
+        for file in files[:-1]:
+            if size <= CORRELATION_CACHE_BYTES:
+                break
+
+            # a correlation memory-mapped by a core (this or another channel) cannot be removed on Windows
+            try:
+                file_size = os.path.getsize(file)
+                os.remove(file)
+            except OSError:
+                continue
+
+            size -= file_size
+            if os.path.isfile(file[:-4] + '.json'):
+                os.remove(file[:-4] + '.json')
+            self.print('Correlation removed from the cache: {}'.format(os.path.basename(file)))
 
     def _load_spr(self):
         try:
@@ -141,19 +353,101 @@ class Core(object):
             self.print('SPR file not found. Diseable ploting of SPR. ')
             return None, None
 
-    def downsample(self, k):
-        if k == 0:
+    def _downsample_key(self, k, mode):
+        # the raw file, the dtypes and samples of the raw data (crops and transpositions)
+        h = hashlib.sha1()
+        h.update(json.dumps(
+            dict(self._cache_header(), downsample=k, mode=mode, work=self.dtype['work'], data_shape=self.shape),
+            sort_keys=True
+        ).encode())
+
+        for f in [0, len(self) // 2, len(self) - 1]:
+            h.update(np.ascontiguousarray(self._data_raw[:, :, f]).tobytes())
+
+        return h.hexdigest()[:16]
+
+    def downsample(self, k, mode=DOWNSAMPLE_MODE):
+        if k <= 1:
             return
-        self._data_raw = scipy.signal.decimate(self._data_raw, k, axis=2)
-        self._time_info = scipy.signal.decimate(self._time_info, k, axis=0)
+
+        if mode == 'decimate':
+            downsample_1d = lambda a, axis=-1: scipy.signal.decimate(a, k, axis=axis)
+        else:
+            downsample_1d = lambda a, axis=-1: tl.block_mean(a, k, axis)
+
+        # the video is processed by chunks of frames, with the memory mapped data the result (and the forward
+        # pass of the filter) is stored in FOLDER_CACHE, so files larger than the memory can be downsampled, the
+        # stored result is reused by the next opening of the file
+        shape = self.shape_img + ((len(self) + k - 1) // k,)
+
+        if self.mmap or self.cache:
+            if not os.path.isdir(self.folder + FOLDER_CACHE):
+                os.mkdir(self.folder + FOLDER_CACHE)
+
+            file_name = self.folder + FOLDER_CACHE + '/' + self.file + '_downsampled_' + self._downsample_key(k, mode)
+
+            if os.path.isfile(file_name + '.npy'):
+                # the modification time orders the eviction
+                os.utime(file_name + '.npy')
+                self.print('Downsampled data loaded from the cache')
+            else:
+                self._downsample_file(file_name, k, mode, shape)
+                self._evict_cache()
+
+            out = tl.load_frame_major(file_name + '.npy', self.mmap)
+
+        else:
+            out = np.zeros(shape, dtype=self.dtype['work'])
+            if mode == 'decimate':
+                tl.decimate_chunks(self._data_raw, k, CHUNK_FRAMES, out)
+            else:
+                tl.block_mean(self._data_raw, k, 2, CHUNK_FRAMES, out)
+
+        self._data_raw = out
+        self.drop_accumulator()
+        self._time_info = downsample_1d(self._time_info, 0)
         self._time_info[:, 1] *= k
         self.downsample_k = k
+        self.downsample_mode = mode
 
         if self.spr_time is not None:
-            self.spr_time = scipy.signal.decimate(self.spr_time, k)
+            self.spr_time = downsample_1d(self.spr_time)
         for key in self.graphs:
             if self.graphs[key] is not None:
-                self.graphs[key] = scipy.signal.decimate(self.graphs[key], k)
+                self.graphs[key] = downsample_1d(self.graphs[key])
+
+    def _downsample_file(self, file_name, k, mode, shape):
+        # the result is written to a temporary file first, so an interrupted run leaves no partial result
+        out = np.lib.format.open_memmap(
+            file_name + '.npy.tmp',
+            mode='w+',
+            dtype=self.dtype['work'],
+            shape=(shape[2], shape[0], shape[1])
+        )
+        buffer = None
+
+        try:
+            if mode == 'decimate':
+                sos, edge = tl.decimation_filter(k, self._data_raw.dtype)
+                buffer = np.lib.format.open_memmap(
+                    file_name + '_filter.npy',
+                    mode='w+',
+                    dtype=sos.dtype,
+                    shape=(len(self) + 2 * edge, shape[0], shape[1])
+                )
+                tl.decimate_chunks(self._data_raw, k, CHUNK_FRAMES, np.moveaxis(out, 0, 2), np.moveaxis(buffer, 0, 2))
+            else:
+                tl.block_mean(self._data_raw, k, 2, CHUNK_FRAMES, np.moveaxis(out, 0, 2))
+
+            out.flush()
+
+        finally:
+            del out
+            if buffer is not None:
+                del buffer
+                os.remove(file_name + '_filter.npy')
+
+        os.replace(file_name + '.npy.tmp', file_name + '.npy')
 
     def _synchronize(self):
         for name_global_spr in [NAME_GLOBAL_SPR, 'spr_integral']:
@@ -215,10 +509,7 @@ class Core(object):
         else:
             self._ref_frame = self.k
 
-        self.reference = np.sum(
-            self._data_raw[:, :, self.ref_frame - self.k: self.ref_frame],
-            axis=2
-        ) / self.k
+        self.reference = self._window_sum(self.ref_frame - self.k, self.ref_frame) / self.k
 
     @property
     def range(self):
@@ -231,12 +522,103 @@ class Core(object):
     def print(self, string):
         print('core {}: {}'.format(self.file[-1], string))
 
+    def _raw(self, start, stop, region=FULL_FRAME):
+        if self._raw_scale == 1:
+            return self._data_raw[region[0], region[1], start: stop]
+
+        return np.multiply(self._data_raw[region[0], region[1], start: stop], self._raw_scale, dtype=self.dtype['work'])
+
+    def build_accumulator(self, chunk=None):
+        # prefix sums in time, S[t] = sum of the frames < t, any window sum then costs two frame reads
+        # with chunk, S[t] = base[t // chunk] + local[t], where the float64 base keeps the precision of the
+        # local sums stored in the working type
+        length = len(self)
+        step = CHUNK_FRAMES if chunk is None else chunk
+
+        if chunk is None:
+            local = np.zeros((length + 1,) + self.shape_img)
+            base = None
+        else:
+            local = np.zeros((length + 1,) + self.shape_img, dtype=self.dtype['work'])
+            base = np.zeros((length // chunk + 1,) + self.shape_img)
+
+        total = np.zeros(self.shape_img)
+        for start in range(0, length + 1, step):
+            if base is not None:
+                base[start // chunk] = total
+                local[start] = 0
+
+            block = np.cumsum(np.moveaxis(self._raw(start, start + step), 2, 0), axis=0, dtype=np.float64)
+            if len(block) == 0:
+                break
+
+            if base is None:
+                local[start + 1: start + 1 + len(block)] = total + block
+            else:
+                local[start + 1: start + 1 + len(block)] = block
+            total += block[-1]
+
+        self._acc_local = local
+        self._acc_base = base
+        self._acc_chunk = chunk
+        self.print('Accumulator built')
+
+    def drop_accumulator(self):
+        self._acc_local = None
+        self._acc_base = None
+        self._acc_chunk = None
+
+    def _prefix(self, t, region=FULL_FRAME):
+        if self._acc_base is None:
+            return self._acc_local[t][region]
+
+        return self._acc_base[t // self._acc_chunk][region] + self._acc_local[t][region]
+
+    def _window_sum(self, start, stop, region=FULL_FRAME):
+        start, stop, _ = slice(start, stop).indices(len(self))
+
+        if self._acc_local is not None and stop > start:
+            return (self._prefix(stop, region) - self._prefix(start, region)).astype(self.dtype['work'], copy=False)
+
+        return np.sum(self._raw(start, stop, region), axis=2)
+
+    def _window_average(self, start, stop, region=FULL_FRAME):
+        start, stop, _ = slice(start, stop).indices(len(self))
+
+        if stop > start:
+            return self._window_sum(start, stop, region) / (stop - start)
+
+        return np.average(self._raw(start, stop, region), axis=2)
+
+    def _new_mask(self):
+        if self.dtype['mask'] == 'packed':
+            return np.zeros((self.shape[0], (self.shape[1] + 7) // 8, self.shape[2]), dtype=np.uint8)
+
+        return np.zeros(self.shape, dtype=self.dtype['mask'])
+
+    def _mask_frames(self, mask, start, stop, region=FULL_FRAME):
+        if self.dtype['mask'] == 'packed':
+            return np.unpackbits(mask[region[0], :, start: stop], axis=1, count=self.shape[1])[:, region[1]]
+
+        return mask[region[0], region[1], start: stop]
+
+    def _mask_set_frame(self, mask, f, image):
+        if self.dtype['mask'] == 'packed':
+            mask[:, :, f] = np.packbits(image.astype(bool), axis=1)
+        else:
+            mask[:, :, f] = image
+
+    def _mask_points_frames(self, start, stop):
+        # the detected NPs are marked from their first frame on
+        images = np.zeros(self.shape_img + (stop - start,), dtype=self.dtype['work'])
+        if self._mask_points is not None:
+            for f in range(start, stop):
+                points = self._mask_points[self._mask_points[:, 2] <= f]
+                images[points[:, 0], points[:, 1], f - start] = 1
+        return images
+
     def intensity(self, f):
-        type_buffer = self.type
-        self.type = 'raw'
-        intensity = np.sum(self.frame(f))
-        self.type = type_buffer
-        return intensity
+        return np.sum(self.frame(f, 'raw'))
 
     def export_data(self, start, stop, name=None):
         if not os.path.isdir(self.folder + FOLDER_SAVED):
@@ -247,9 +629,8 @@ class Core(object):
 
         file_name = self.folder + FOLDER_SAVED + '/' + name
 
-        data = np.zeros(self.shape)
-        for f in range(start, stop):
-            data[:, :, f] = self.frame(f)
+        data = np.zeros(self.shape, dtype=self.dtype['work'])
+        self.frames(start, stop, out=data[:, :, start: stop])
 
         if tl.before_save_file(file_name) or name == self.file:
             np.save(file_name + '.npy', data)
@@ -321,10 +702,10 @@ class Core(object):
                 if npp.color == green:
                     f.write(
                         '{}, {}, {}, {}\n'.format(
-                            npp.positions[0][0],
-                            npp.positions[0][1],
+                            npp.x,
+                            npp.y,
                             npp.first_frame * self.downsample_k,
-                            len(npp.positions)
+                            npp.duration
                         ))
 
         with open(file_name + '_log.txt', mode='w') as f:
@@ -332,6 +713,93 @@ class Core(object):
 
             self.print('Data exported')
 
+    def export_np_traces(self, itype=None, images=False, name=None, progress_callback=None, cancel=None):
+        # traces of all NPs, the averages over the surroundings (n NPs, 2 * NP_TRACE_FRAMES) or the images of the
+        # surroundings (n NPs, 2 * NP_TRACE_FRAMES, 2 * NP_TRACE_SIZE + 1, 2 * NP_TRACE_SIZE + 1), saved to
+        # FOLDER_EXPORTS_NP_SURROUNDINGS as a memory mapped .npy, pixels and frames out of the video are nan
+        if len(self.np_container) == 0:
+            raise Exception('No detected NPs yet')
+
+        if itype is None:
+            itype = self.type
+
+        if not os.path.isdir(self.folder + FOLDER_EXPORTS_NP_SURROUNDINGS):
+            os.mkdir(self.folder + FOLDER_EXPORTS_NP_SURROUNDINGS)
+
+        if name == None:
+            name = self.file
+
+        file_name = self.folder + FOLDER_EXPORTS_NP_SURROUNDINGS + '/' + name + '_' + itype + ('_images' if images else '')
+
+        size = NP_TRACE_SIZE
+        side = 2 * size + 1
+        length = 2 * NP_TRACE_FRAMES
+        h, w = self.shape_img
+
+        records = self.np_container.records
+        rows = np.clip(np.round(records['x']).astype(int), 0, h - 1)
+        cols = np.clip(np.round(records['y']).astype(int), 0, w - 1)
+        starts = records['first_frame'] - NP_TRACE_FRAMES
+        order = np.argsort(starts, kind='stable')
+
+        # pixels of the surroundings within the frame
+        area = (np.minimum(rows + size, h - 1) - np.maximum(rows - size, 0) + 1) * \
+               (np.minimum(cols + size, w - 1) - np.maximum(cols - size, 0) + 1)
+
+        out = np.lib.format.open_memmap(
+            file_name + '.npy',
+            mode='w+',
+            dtype=self.dtype['work'],
+            shape=(len(records), length, side, side) if images else (len(records), length)
+        )
+        out[:] = np.nan
+
+        padded = np.full((h + 2 * size, w + 2 * size, CHUNK_FRAMES), np.nan, dtype=self.dtype['work'])
+        for start in range(0, len(self), CHUNK_FRAMES):
+            if cancel is not None and cancel.is_set():
+                # no partial export is left
+                del out
+                os.remove(file_name + '.npy')
+                self._check_cancel(cancel)
+
+            stop = min(start + CHUNK_FRAMES, len(self))
+
+            # NPs with the window overlapping the chunk
+            ids = order[
+                  np.searchsorted(starts[order], start - length, side='right'):
+                  np.searchsorted(starts[order], stop)
+                  ]
+
+            if len(ids) != 0:
+                self.frames(start, stop, itype, out=padded[size: size + h, size: size + w, :stop - start])
+
+                # windows[r, c, t] are the surroundings of the pixel [r, c] in the frame start + t
+                windows = np.lib.stride_tricks.sliding_window_view(
+                    padded[:, :, :stop - start],
+                    (side, side),
+                    axis=(0, 1)
+                )
+
+                t = starts[ids, np.newaxis] + np.arange(length)
+                i, j = np.nonzero((t >= start) & (t < stop))
+
+                for b in range(0, len(i), NP_TRACE_BATCH):
+                    ii = ids[i[b: b + NP_TRACE_BATCH]]
+                    jj = j[b: b + NP_TRACE_BATCH]
+                    patches = windows[rows[ii], cols[ii], starts[ii] + jj - start]
+
+                    if images:
+                        out[ii, jj] = patches
+                    else:
+                        out[ii, jj] = np.nansum(patches, axis=(1, 2)) / area[ii]
+
+            if progress_callback is not None:
+                progress_callback.emit(stop / len(self) * 100)
+
+        out.flush()
+        self.print('NP traces exported')
+        return out
+
     def import_np_csv(self, name=None):
         if name is None:
             name = self.file
@@ -341,8 +809,7 @@ class Core(object):
             with open(file_name + '.csv', 'r') as csv:
                 contents = csv.readlines()
 
-            self.np_container = []
-            self.nps_in_frame = [[] for i in range(len(self))]
+            self.np_container = NPTable()
             self.graphs['nps_pos'] = np.array([0] * len(self))
 
             for i, line in enumerate(contents):
@@ -350,24 +817,18 @@ class Core(object):
 
                 first_frame = int(np.round(int(line_split[2]) / self.downsample_k))
                 duration = int(np.round(int(line_split[3])))
-                positions = [np.array([float(line_split[0]), float(line_split[1])])] * duration
 
-                nnp = NanoParticle(
-                    i,
+                self.np_container.append(
+                    float(line_split[0]),
+                    float(line_split[1]),
                     first_frame,
-                    positions,
-                    positive=True
+                    duration,
+                    positive=True,
+                    color=green
                 )
-                nnp.color = green
 
                 self.graphs['nps_pos'][first_frame] += 1
 
-                for j in range(duration):
-                    if first_frame + j < len(self):
-                        self.nps_in_frame[first_frame + j].append(i)
-
-                self.np_container.append(nnp)
-
             self.show_nps = True
             self.print('NPs succesfully imported.')
 
@@ -389,10 +850,10 @@ class Core(object):
                 if npp.color == green:
                     f.write(
                         '{}, {}, {}, {}\n'.format(
-                            npp.positions[0][0],
-                            npp.positions[0][1],
+                            npp.x,
+                            npp.y,
                             npp.first_frame,
-                            len(npp.positions)
+                            npp.duration
                         ))
 
         with open(file_name + '_log.txt', mode='w') as f:
@@ -409,8 +870,7 @@ class Core(object):
             with open(file_name + '.csv', 'r') as csv:
                 contents = csv.readlines()
 
-            self.np_container = []
-            self.nps_in_frame = [[] for i in range(len(self))]
+            self.np_container = NPTable()
             self.graphs['nps_pos'] = np.array([0 for i in range(len(self))])
 
             for i, line in enumerate(contents):
@@ -418,23 +878,18 @@ class Core(object):
 
                 first_frame = int(line_split[2])
                 duration = int(line_split[3])
-                positions = [np.array([float(line_split[0]), float(line_split[1])])] * duration
 
-                nnp = NanoParticle(
-                    i,
+                self.np_container.append(
+                    float(line_split[0]),
+                    float(line_split[1]),
                     first_frame,
-                    positions,
-                    positive=True
+                    duration,
+                    positive=True,
+                    color=green
                 )
-                nnp.color = green
 
                 self.graphs['nps_pos'][first_frame] += 1
 
-                for j in range(duration):
-                    self.nps_in_frame[first_frame + j].append(i)
-
-                self.np_container.append(nnp)
-
             self.show_nps = True
             self.print('NPs succesfully imported.')
 
@@ -442,33 +897,50 @@ class Core(object):
             self.print('"{}"  not found. Diseable ploting of SPR. '.format(file_name))
             return None, None
 
-    def defects_removal(self, level):
-        k_buffer = self.k
-        type_buffer = self.type
-
-        self.type = 'diff'
-        self.k = 1
+    def defects_removal(self, level, progress_callback=None, cancel=None):
+        # the diff frames of k = 1 without any defects mask, computed here so the settings of the core are not
+        # touched while it runs as a job
 
-        mask_defects = np.zeros(self.shape)
-        self._mask_defects = None
+        mask_defects = self._new_mask()
 
-        background = np.average(np.abs(self._data_raw[:, :, :-1] - self._data_raw[:, :, 1:]))
+        background = 0
+        for start in range(0, len(self) - 1, CHUNK_FRAMES):
+            self._check_cancel(cancel)
+            block = self._raw(start, start + CHUNK_FRAMES + 1)
+            background += np.sum(np.abs(block[:, :, :-1] - block[:, :, 1:]))
+        background /= self.area * (len(self) - 1)
         self.print('background: {}'.format(background))
 
-        for f in range(len(self)):
-            print('\r\t{}/ {}'.format(f, len(self)), end='')
+        for start in range(0, len(self), CHUNK_FRAMES):
+            self._check_cancel(cancel)
+            stop = min(start + CHUNK_FRAMES, len(self))
+            print('\r\t{}/ {}'.format(stop, len(self)), end='')
+
+            first = max(start - 1, 0)
+            block = self._raw(first, stop)
+            diffs = block[:, :, 1:] - block[:, :, :-1]
+            for f in range(start, stop):
+                if f == 0:
+                    image = block[:, :, 0]
+                else:
+                    image = diffs[:, :, f - first - 1]
 
-            mask_defects[:, :, f] = (np.abs(self.frame(f)) < background * level) * 1
-            mask_defects[:, :, f] = (gaussian_filter(mask_defects[:, :, f], 2) > 0.8) * 1
+                # the first 2 * k frames are not postprocessed, as in _frame
+                if f >= 2:
+                    image = self._postprocess(image, f, 'diff')
 
-        self._mask_defects = mask_defects
+                # the comparison is filtered as a float image, an integer one would be truncated by gaussian_filter
+                image = (np.abs(image) < background * level).astype(np.float64)
+                self._mask_set_frame(mask_defects, f, (gaussian_filter(image, 2) > 0.8) * 1)
+
+            if progress_callback is not None:
+                progress_callback.emit(stop / len(self) * 100)
 
-        self.type = type_buffer
-        self.k = k_buffer
+        self._mask_defects = mask_defects
 
     def noise_analysis(self, avg):
-        intensity = np.average(self._data_raw) * PX_DEPTH
-        std = np.average(np.std(self._data_raw, axis=2)) * PX_DEPTH
+        intensity = np.average(self._data_raw) * self._raw_scale * PX_DEPTH
+        std = np.average(tl.std_time(self._data_raw, CHUNK_FRAMES)) * self._raw_scale * PX_DEPTH
         shot_noise = (1 / intensity / avg) ** 0.5
         noise = std / intensity
 
@@ -477,95 +949,103 @@ class Core(object):
         self.print('noise: {}'.format(noise))
         self.print('{:.1f} % of shot noise'.format(noise / shot_noise * 100))
 
-    def np_analysis(self):
-        if self.np_container == []:
+    def np_analysis(self, progress_callback=None, cancel=None, itype=None, traces=False):
+        # the new colors of the NPs are returned with their table, set_np_colors applies them, so it may run as a
+        # job while the NPs are shown, the NPs are cut out of the frames of itype, with traces the traces of the NPs
+        # are exported as well (export_np_traces)
+        if itype is None:
+            itype = self.type
+
+        np_container = self.np_container
+        if len(np_container) == 0:
             raise Exception('No detected NPs yet')
 
         d = 0
         list_results = []
-        if len(self.np_container) > 1000:
-            step = len(self.np_container) // 1000
-        else:
-            step = 1
+        colors = dict()
 
-        file_name = self.folder + FOLDER_SAVED + '/np_analysis_all_' + self.file
-        with open(file_name + '.csv', mode='w') as f_nps:
+        def surroundings(npp):
+            f = (npp.first_frame + npp.last_frame) // 2
 
-            for i, npp in enumerate(self.np_container[::step]):
-                if npp.color == red:
-                    continue
+            size = 15
+            ind_0 = [
+                int(npp.position(f)[1] - size),
+                int(npp.position(f)[1] + size)
+            ]
+
+            if ind_0[0] < 0:
+                ind_0[0] = 0
+                x0 = ind_0[0] = 0
+            else:
+                x0 = size
 
-                print('\r\t{}/ {}'.format(i, len(self.np_container[::step])), end='')
-                f = (npp.first_frame + npp.last_frame) // 2
+            if ind_0[1] > self.shape_img[0]: ind_0[1] = self.shape_img[0]
 
-                size = 15
-                ind_0 = [
-                    int(npp.position(f)[1] - size),
-                    int(npp.position(f)[1] + size)
-                ]
+            ind_1 = [
+                int(npp.position(f)[0] - size),
+                int(npp.position(f)[0] + size)
+            ]
+            if ind_1[0] < 0:
+                ind_1[0] = 0
+                y0 = 25 + ind_1[0]
+            else:
+                y0 = size
 
-                if ind_0[0] < 0:
-                    ind_0[0] = 0
-                    x0 = ind_0[0] = 0
-                else:
-                    x0 = size
+            if ind_1[1] > self.shape_img[1]:
+                ind_1[1] = self.shape_img[1]
 
-                if ind_0[1] > self.shape_img[0]: ind_0[1] = self.shape_img[0]
+            roi = (ind_0[0], ind_0[1], ind_1[0], ind_1[1])
 
-                ind_1 = [
-                    int(npp.position(f)[0] - size),
-                    int(npp.position(f)[0] + size)
-                ]
-                if ind_1[0] < 0:
-                    ind_1[0] = 0
-                    y0 = 25 + ind_1[0]
-                else:
-                    y0 = size
+            # fc = npp.first_frame + np.argmax(np_intensity)
+            fc = npp.first_frame + npp.duration // 2
+            return self.frame_roi(fc, roi, itype), x0, y0
 
-                if ind_1[1] > self.shape_img[1]:
-                    ind_1[1] = self.shape_img[1]
+        # with the traces, the fits are the first half of the progress
+        progress_fits = tl.ProgressRange(progress_callback, 0, 50 if traces else 100)
 
-                np_intensity = [
-                    np.average(
-                        np.abs(
-                            self.frame(f)[ind_0[0]: ind_0[1], ind_1[0]: ind_1[1]]
-                        )
-                    )
-                    for f in range(npp.first_frame, npp.last_frame)
-                ]
-
-
-                # fc = npp.first_frame + np.argmax(np_intensity)
-                fc = npp.first_frame + len(npp.positions)//2
-                surroundings = self.frame(fc)[ind_0[0]: ind_0[1], ind_1[0]: ind_1[1]]
-                #
-                # current = (surroundings - np.min(surroundings)) / (np.max(surroundings) - np.min(surroundings)) * 255
-                # current[current > 255] = 255
-                # current[current < 0] = 0
-                #
-                # pilimage = Image.fromarray(current.astype(np.uint8))
-                #
-                # pilimage.save(self.folder + FOLDER_SAVED + '/np_{:04d}.png'.format(i), 'png')
-
-                result = tl.np_analysis(surroundings, x0, y0, self.folder, self.file, i % 5 == 0)
-
-                if type(result) is list:
-                    f_nps.write(
-                        '{}, {}, {}, {}, {}, {} \n'.format(
-                            result[0],
-                            result[1],
-                            result[2],
-                            result[3],
-                            result[4],
-                            result[5]
+        file_name = self.folder + FOLDER_SAVED + '/np_analysis_all_' + self.file
+        with open(file_name + '.csv', mode='w') as f_nps, ProcessPoolExecutor(max_workers=NP_FIT_PROCESSES) as pool:
+
+            # the NPs are cut out in batches and fitted by the pool
+            for batch_start in range(0, len(np_container), NP_FIT_BATCH):
+                self._check_cancel(cancel)
+                batch = []
+                for i, npp in enumerate(np_container[batch_start: batch_start + NP_FIT_BATCH], batch_start):
+                    if npp.color == red:
+                        continue
+                    batch.append((i, npp))
+
+                print('\r\t{}/ {}'.format(
+                    min(batch_start + NP_FIT_BATCH, len(np_container)),
+                    len(np_container)
+                ), end='')
+
+                images, x0s, y0s = zip(*[surroundings(npp) for _, npp in batch]) if batch else ([], [], [])
+
+                fits = pool.map(tl.np_fit, images, x0s, y0s)
+                for (j, npp), image, (result, threshold) in zip(batch, images, fits):
+                    if type(result) is list:
+                        f_nps.write(
+                            '{}, {}, {}, {}, {}, {} \n'.format(
+                                result[0],
+                                result[1],
+                                result[2],
+                                result[3],
+                                result[4],
+                                result[5]
+                            )
                         )
-                    )
 
-                    list_results.append(result)
-                    npp.color = blue
-                    d += 1
-                else:
-                    npp.color = purple
+                        if j % 5 == 0:
+                            tl.save_np_image(image, threshold, self.folder, self.file)
+
+                        list_results.append(result)
+                        colors[j] = blue
+                        d += 1
+                    else:
+                        colors[j] = purple
+
+                progress_fits.emit(min(batch_start + NP_FIT_BATCH, len(np_container)) / len(np_container) * 100)
 
         with open(file_name + '_log.txt', mode='w') as f:
             f.write(
@@ -618,6 +1098,18 @@ class Core(object):
             )
         self.print('Analysis saved as: {}'.format(file_name + '.csv'))
 
+        if traces:
+            self.export_np_traces(itype, progress_callback=tl.ProgressRange(progress_callback, 50, 100), cancel=cancel)
+
+        return np_container, colors
+
+    def set_np_colors(self, analysis):
+        # analysis: the result of np_analysis, the colors are dropped if the NPs were counted again meanwhile
+        np_container, colors = analysis
+        if np_container is self.np_container:
+            for np_id, color in colors.items():
+                np_container[np_id].color = color
+
     def save_idea(self, name=None):
         if not os.path.isdir(self.folder + FOLDER_IDEAS):
             os.mkdir(self.folder + FOLDER_IDEAS)
@@ -640,7 +1132,7 @@ class Core(object):
 
             # self.print('Autocorrelation max: {}'.format(self.autocorrelation_max))
             # self.print('RAW avg: {}'.format(np.average(self._data_raw)))
-            self._data_avg = np.average(self._data_raw)
+            self._data_avg = np.average(self._data_raw) * self._raw_scale
 
 
         else:
@@ -662,7 +1154,7 @@ class Core(object):
 
             # self.print('Autocorrelation max: {}'.format(self.autocorrelation_max))
             # self.print('RAW avg: {}'.format(np.average(self._data_raw)))
-            self._data_avg = np.average(self._data_raw)
+            self._data_avg = np.average(self._data_raw) * self._raw_scale
 
             return True
         except FileNotFoundError:
@@ -693,23 +1185,17 @@ class Core(object):
             self._mask_fourier = np.zeros(self.shape_img)
             return False
 
-    def frame_diff(self, f):
+    def frame_diff(self, f, region=FULL_FRAME):
 
-        current = np.sum(
-            self._data_raw[:, :, f - self.k + 1: f + 1],
-            axis=2
-        ) / self.k
-        previous = np.sum(
-            self._data_raw[:, :, f - 2 * self.k + 1: f - self.k + 1],
-            axis=2
-        ) / self.k
+        current = self._window_sum(f - self.k + 1, f + 1, region) / self.k
+        previous = self._window_sum(f - 2 * self.k + 1, f - self.k + 1, region) / self.k
 
         if self._mask_defects is None:
             return (current - previous)
 
         else:
             mask_pre = np.sum(
-                self._mask_defects[:, :, f - 2 * self.k + 1: f + 1],
+                self._mask_frames(self._mask_defects, f - 2 * self.k + 1, f + 1, region),
                 axis=2
             ) / self.k / 2
 
@@ -719,49 +1205,159 @@ class Core(object):
 
             # return (current - previous) * mask
 
-    def frame(self, f):
-        self._f = f
-        no_postpro = ['raw', 'four_d', 'four_i', 'mask', 'corr']
-        if self.type == 'diff':
+    def frame(self, f, itype=None):
+        if itype is None:
+            itype = self.type
+            self._f = f
+
+        if not self._frame_cacheable(itype):
+            return self._frame(f, itype)
+
+        key = self._frame_key(f, itype)
+        image = self.frame_cache.get(key)
+
+        if image is None:
+            image = self._frame(f, itype)
+            image.flags.writeable = False
+            self.frame_cache.put(key, image)
+
+        return image
+
+    def _frame_cacheable(self, itype):
+        if itype in ['raw', 'mask']:
+            return False
+
+        if itype == 'corr':
+            return self.threshold or self._data_corr is None
+
+        return True
+
+    def _frame_key(self, f, itype):
+        # arrays are compared by identity, a replaced array (new mask, correlation, ...) clears the cache and
+        # starts a new generation, so the frames computed from the previous arrays never match a key again
+        state = (
+            self._data_raw,
+            self.reference,
+            self._mask_fourier,
+            self._mask_defects,
+            self._data_corr,
+            self._data_corr_std,
+            self.idea3d
+        )
+        with self._frame_state_lock:
+            if self._frame_state is None or any(a is not b for a, b in zip(state, self._frame_state)):
+                self.frame_cache.clear()
+                self._frame_state = state
+                self._frame_generation += 1
+            generation = self._frame_generation
+
+        if itype == 'corr' and self.threshold:
+            threshold = self._threshold_settings()
+        else:
+            threshold = None
+
+        return (
+            itype,
+            f,
+            generation,
+            self.k,
+            self._ref_frame,
+            self.postprocessing,
+            tuple(self.postprocessing_filters.items()) if self.postprocessing else None,
+            self.threshold and itype == 'corr',
+            threshold
+        )
+
+    def frame_ready(self, f, itype=None):
+        # the frame is in the cache already or it is computed on demand only
+        if itype is None:
+            itype = self.type
+
+        if not self._frame_cacheable(itype) or self.frame_cache.max_bytes == 0:
+            return True
+
+        return self._frame_key(f % len(self), itype) in self.frame_cache
+
+    def clear_frame_cache(self):
+        self.frame_cache.clear()
+
+    def prefetch(self, frames, itype=None):
+        # computes the frames into the cache on background threads
+        if itype is None:
+            itype = self.type
+
+        if not self._frame_cacheable(itype) or self.frame_cache.max_bytes == 0:
+            return
+
+        if self._prefetch_pool is None:
+            self._prefetch_pool = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS)
+
+        for f in frames:
+            f = f % len(self)
+            key = self._frame_key(f, itype)
+
+            with self._prefetch_lock:
+                if key in self.frame_cache or key in self._prefetch_pending:
+                    continue
+                self._prefetch_pending[key] = self._prefetch_pool.submit(self._prefetch_frame, f, itype, key)
+
+    def cancel_prefetch(self, keep=()):
+        # drops the queued frames not in keep, the frames being computed are finished
+        with self._prefetch_lock:
+            for key, future in list(self._prefetch_pending.items()):
+                if key[1] not in keep and future.cancel():
+                    del self._prefetch_pending[key]
+
+    def _prefetch_frame(self, f, itype, key):
+        try:
+            # the settings may change while the frame waits or is computed, such frame is not cached
+            if key != self._frame_key(f, itype):
+                return
+
+            image = self._frame(f, itype)
+
+            if key == self._frame_key(f, itype):
+                image.flags.writeable = False
+                self.frame_cache.put(key, image)
+        finally:
+            with self._prefetch_lock:
+                self._prefetch_pending.pop(key, None)
+
+    def _frame(self, f, itype):
+        if itype == 'diff':
             image = self.frame_diff(f)
             if f < 2 * self.k:
                 return image
 
-        elif self.type == 'int':
-            current = np.average(
-                self._data_raw[:, :, f // self.k * self.k - self.k: f // self.k * self.k],
-                axis=2
-            )
+        elif itype == 'int':
+            current = self._window_average(f // self.k * self.k - self.k, f // self.k * self.k)
             image = current - self.reference
 
-        elif self.type == 'raw':
-            image = self._data_raw[:, :, f]
+        elif itype == 'raw':
+            image = self._raw(f, f + 1)[:, :, 0]
 
-        elif self.type == 'mask':
-            if self._data_mask is None:
+        elif itype == 'mask':
+            if self._mask_points is None:
                 # if self._mask_defects is None:
                 image = np.zeros(self.shape_img)
             else:
-                image = self._data_mask[:, :, f]
+                image = self._mask_points_frames(f, f + 1)[:, :, 0]
                 # image = self._mask_defects[:, :, f]
 
-        elif self.type == 'four_r':
-            image_pre = self._data_raw[:, :, f]
+        elif itype == 'four_r':
+            image_pre = self._raw(f, f + 1)[:, :, 0]
             image = np.real(20 * np.log(np.abs(np.fft.fft2(image_pre))))
 
-        elif self.type == 'four_i':
-            current = np.average(
-                self._data_raw[:, :, f // self.k * self.k - self.k: f // self.k * self.k],
-                axis=2
-            )
+        elif itype == 'four_i':
+            current = self._window_average(f // self.k * self.k - self.k, f // self.k * self.k)
             image_pre = current - self.reference
             image = np.real(20 * np.log(np.abs(np.fft.fft2(image_pre))))
 
-        elif self.type == 'four_d':
+        elif itype == 'four_d':
             image_pre = self.frame_diff(f)
             image = np.real(20 * np.log(np.abs(np.fft.fft2(image_pre))))
 
-        elif self.type == 'corr':
+        elif itype == 'corr':
             if self.idea3d is None:
                 image = np.zeros(self.shape_img[0])
                 self.print('No selected NP patter for file {}'.format(self.file))
@@ -788,7 +1384,11 @@ class Core(object):
 
                 image = out[:, :, 2 * self.k]
 
-        if self.type not in no_postpro:
+        return self._postprocess(image, f, itype)
+
+    def _postprocess(self, image, f, itype):
+        no_postpro = ['raw', 'four_d', 'four_i', 'mask', 'corr']
+        if itype not in no_postpro:
             if self._mask_fourier is not None and self.postprocessing:
                 f = np.fft.fft2(image)
                 f[self._mask_fourier] = 0
@@ -799,7 +1399,7 @@ class Core(object):
                 for p in self.postprocessing_filters.values():
                     image = p(image)
 
-        if self.threshold and self.type == 'corr':
+        if self.threshold and itype == 'corr':
 
             if self.threshold_value > 0:
                 image = ndimage.maximum_filter(image, size=2)
@@ -810,92 +1410,341 @@ class Core(object):
 
                     image = (
                                     image / self._data_avg > level ** self.threshold_adaptive * self.autocorrelation_max * self.threshold_value) * \
-                            self._range[self.type][1]
+                            self._range[itype][1]
                 else:
                     image = (image / self._data_avg > self.autocorrelation_max * self.threshold_value) * \
-                            self._range[self.type][1]
+                            self._range[itype][1]
 
-                # image = (image > self.autocorrelation_max * self.threshold_value / 50) * self._range[self.type][1]
+                # image = (image > self.autocorrelation_max * self.threshold_value / 50) * self._range[itype][1]
 
             else:
                 image = -ndimage.maximum_filter(-image, size=2)
                 image = (image < self._data_corr_std[f] / np.average(
                     self._data_corr_std[self.k * 3:]) * self.autocorrelation_max * self.threshold_value) * \
-                        self._range[self.type][1]
+                        self._range[itype][1]
 
-                # image = (image < self.autocorrelation_max * self.threshold_value/50) * self._range[self.type][1]
+                # image = (image < self.autocorrelation_max * self.threshold_value/50) * self._range[itype][1]
 
         return image
 
+    def frame_roi(self, f, roi, itype=None, margin=ROI_MARGIN):
+        # the frame f within roi = (x0, x1, y0, y1) only, the local filters are evaluated with the margin
+        # around it, the global operations (Fourier mask, FILTERS_GLOBAL) need the full frame
+        if itype is None:
+            itype = self.type
+
+        rows = slice(*slice(roi[0], roi[1]).indices(self.shape_img[0])[:2])
+        cols = slice(*slice(roi[2], roi[3]).indices(self.shape_img[1])[:2])
+
+        if itype == 'corr' and self.idea3d is None:
+            self.print('No selected NP patter for file {}'.format(self.file))
+            return np.zeros((max(rows.stop - rows.start, 0), max(cols.stop - cols.start, 0)))
+
+        postprocessing = self.postprocessing and itype in ['diff', 'int']
+        full_frame = itype not in ['diff', 'int', 'raw', 'corr'] or \
+                     itype == 'corr' and self._data_corr is None or \
+                     postprocessing and self._mask_fourier is not None or \
+                     postprocessing and any(name in FILTERS_GLOBAL for name in self.postprocessing_filters)
+
+        if self._frame_cacheable(itype):
+            image = self.frame_cache.get(self._frame_key(f, itype))
+            if image is not None:
+                return image[rows, cols]
+
+        if full_frame:
+            return self.frame(f, itype)[rows, cols]
+
+        region = (
+            slice(max(rows.start - margin, 0), min(rows.stop + margin, self.shape_img[0])),
+            slice(max(cols.start - margin, 0), min(cols.stop + margin, self.shape_img[1]))
+        )
+        inner = (
+            slice(rows.start - region[0].start, rows.stop - region[0].start),
+            slice(cols.start - region[1].start, cols.stop - region[1].start)
+        )
+
+        if itype == 'diff':
+            image = self.frame_diff(f, region)
+            if f < 2 * self.k:
+                return image[inner]
+
+        elif itype == 'int':
+            current = self._window_average(f // self.k * self.k - self.k, f // self.k * self.k, region)
+            image = current - self.reference[region]
+
+        elif itype == 'raw':
+            image = self._raw(f, f + 1, region)[:, :, 0]
+
+        else:
+            image = self._data_corr[region[0], region[1], f]
+
+        return self._postprocess(image, f, itype)[inner]
+
+    def frames(self, start, stop, itype=None, out=None):
+        if itype is None:
+            itype = self.type
+
+        if out is None:
+            out = np.zeros(self.shape_img + (stop - start,), dtype=self.dtype['work'])
+
+        # the first frames use wrapped windows, they are computed one by one
+        first = min(max(start, 2 * self.k), stop)
+        for f in range(start, first):
+            out[:, :, f - start] = self.frame(f, itype)
+
+        for chunk_start in range(first, stop, CHUNK_FRAMES):
+            chunk_stop = min(chunk_start + CHUNK_FRAMES, stop)
+            out[:, :, chunk_start - start: chunk_stop - start] = np.moveaxis(
+                self._frames(chunk_start, chunk_stop, itype),
+                0,
+                2
+            )
+
+        return out
+
+    def _prefix_block(self, start, stop):
+        # prefix sums S[start], ..., S[stop] as a frame-major float64 block
+        if self._acc_local is not None:
+            block = self._acc_local[start: stop + 1].astype(np.float64)
+            if self._acc_base is not None:
+                block += self._acc_base[np.arange(start, stop + 1) // self._acc_chunk]
+            return block, start
+
+        block = np.zeros((stop - start + 1,) + self.shape_img)
+        np.cumsum(np.moveaxis(self._raw(start, stop), 2, 0), axis=0, out=block[1:])
+        return block, start
+
+    def _frames(self, start, stop, itype):
+        # vectorized version of _frame for start >= 2 * k, returns a frame-major block
+        no_postpro = ['raw', 'four_d', 'four_i', 'mask', 'corr']
+        frames = np.arange(start, stop)
+        k = self.k
+
+        if itype in ['diff', 'four_d']:
+            prefix, p0 = self._prefix_block(start - 2 * k + 1, stop)
+            current = (prefix[frames + 1 - p0] - prefix[frames - k + 1 - p0]) / k
+            previous = (prefix[frames - k + 1 - p0] - prefix[frames - 2 * k + 1 - p0]) / k
+            images = current - previous
+
+            if self._mask_defects is not None:
+                mask = np.moveaxis(self._mask_frames(self._mask_defects, start - 2 * k + 1, stop), 2, 0)
+                mask_prefix = np.zeros((len(mask) + 1,) + self.shape_img)
+                np.cumsum(mask, axis=0, out=mask_prefix[1:])
+                window = frames - (start - 2 * k + 1)
+                mask_pre = (mask_prefix[window + 1] - mask_prefix[window + 1 - 2 * k]) / k / 2
+                images = images * ((mask_pre == 1) * 1)
+
+            if itype == 'four_d':
+                images = np.real(20 * np.log(np.abs(np.fft.fft2(images))))
+
+        elif itype in ['int', 'four_i']:
+            integral = frames // k * k
+            prefix, p0 = self._prefix_block(integral[0] - k, integral[-1])
+            images = (prefix[integral - p0] - prefix[integral - k - p0]) / k - self.reference
+
+            if itype == 'four_i':
+                images = np.real(20 * np.log(np.abs(np.fft.fft2(images))))
+
+        elif itype == 'raw':
+            images = np.moveaxis(self._raw(start, stop), 2, 0)
+
+        elif itype == 'four_r':
+            images = np.real(20 * np.log(np.abs(np.fft.fft2(np.moveaxis(self._raw(start, stop), 2, 0)))))
+
+        elif itype == 'mask':
+            images = np.moveaxis(self._mask_points_frames(start, stop), 2, 0)
+
+        elif itype == 'corr' and self.idea3d is not None and self._data_corr is not None:
+            images = np.moveaxis(self._data_corr[:, :, start: stop], 2, 0)
+
+        else:
+            return np.array([self.frame(f, itype) for f in frames])
+
+        if itype not in no_postpro:
+            if self._mask_fourier is not None and self.postprocessing:
+                spectrum = np.fft.fft2(images)
+                spectrum[:, self._mask_fourier] = 0
+                images = np.real(np.fft.ifft2(spectrum))
+
+            if self.postprocessing and len(self.postprocessing_filters) != 0:
+                images = np.array(images)
+                for i in range(len(images)):
+                    for p in self.postprocessing_filters.values():
+                        images[i] = p(images[i])
+
+        if self.threshold and itype == 'corr':
+            level = self._data_corr_std[frames] / np.average(self._data_corr_std[self.k * 3:])
+            images = self._threshold_block(images, level, self._threshold_settings())
+
+        return images
+
+    def _threshold_settings(self):
+        return (
+            self.threshold_value,
+            self.threshold_adaptive,
+            self._range['corr'][1],
+            self._data_avg,
+            self.autocorrelation_max
+        )
+
+    def _threshold_block(self, images, level, settings):
+        # thresholded frame-major block of the correlation, level: the relative std of every frame
+        value, adaptive, top, data_avg, autocorrelation_max = settings
+
+        if value > 0:
+            images = ndimage.maximum_filter(images, size=(1, 2, 2))
+            level = np.where(level > 1, level ** adaptive, 1)
+            threshold = level * autocorrelation_max * value
+            return (images / data_avg > threshold[:, np.newaxis, np.newaxis]) * top
+
+        images = -ndimage.maximum_filter(-images, size=(1, 2, 2))
+        threshold = level * autocorrelation_max * value
+        return (images < threshold[:, np.newaxis, np.newaxis]) * top
+
     def fourier(self, image):
         f = np.fft.fft2(image)
         mask = np.abs(f) > np.exp(self.fourier_level / 20)
         f[mask] = 0
         return np.real(np.fft.ifft2(f))
 
-    def apply_function(self, fn, progress_callback):
-        out = []
-        for f in range(len(self)):
-            out.append(fn(self.frame(f)))
-            # print('\r\t{}/ {}'.format(f + 1, len(self)), end='')
-            progress_callback.emit((f + 1) / len(self) * 100)
-        return np.array(out)
+    def _check_cancel(self, cancel):
+        # cancel: the threading.Event of the running job, set to stop it, None if it cannot be cancelled
+        if cancel is not None and cancel.is_set():
+            raise Exception('Processing of the file {} cancelled'.format(self.file))
+
+    def _map_chunks(self, fn, progress_callback=None, cancel=None):
+        # fn(start, stop) is called for all chunks of the video by a pool of threads (numpy releases the GIL)
+        def run(start, stop):
+            if cancel is None or not cancel.is_set():
+                fn(start, stop)
+            return stop - start
+
+        with ThreadPoolExecutor(max_workers=APPLY_WORKERS or os.cpu_count()) as pool:
+            futures = [
+                pool.submit(run, start, min(start + CHUNK_FRAMES, len(self)))
+                for start in range(0, len(self), CHUNK_FRAMES)
+            ]
+
+            done = 0
+            for future in as_completed(futures):
+                done += future.result()
+                if progress_callback is not None:
+                    progress_callback.emit(done / len(self) * 100)
+
+        self._check_cancel(cancel)
+
+    def apply_function(self, fn, progress_callback, itype=None, cancel=None):
+        out = np.zeros(len(self))
+
+        def chunk(start, stop):
+            out[start: stop] = fn(self.frames(start, stop, itype), axis=(0, 1))
+
+        self._map_chunks(chunk, progress_callback, cancel)
+        return out
+
+    def frame_statistics(self, statistics, progress_callback=None, cancel=None):
+        # statistics = {itype: ['sum', 'mean', 'std', 'min', 'max', ...]}, all are computed in a single pass over
+        # the video, every chunk of every type is computed once, returns {itype: {statistic: values per frame}}
+        functions = {
+            'sum': np.sum,
+            'mean': np.mean,
+            'std': np.std,
+            'min': np.min,
+            'max': np.max
+        }
+
+        out = {itype: {name: np.zeros(len(self)) for name in names} for itype, names in statistics.items()}
+
+        def chunk(start, stop):
+            for itype, names in statistics.items():
+                block = self.frames(start, stop, itype)
+                for name in names:
+                    out[itype][name][start: stop] = functions[name](block, axis=(0, 1))
+
+        self._map_chunks(chunk, progress_callback, cancel)
+        return out
+
+    def make_graphs(self, keys, progress_callback=None, cancel=None):
+        # fills the graphs of GRAPH_STATISTICS in one pass
+        statistics = dict()
+        for key in keys:
+            itype, name = GRAPH_STATISTICS[key]
+            statistics.setdefault(itype, [])
+            if name not in statistics[itype]:
+                statistics[itype].append(name)
+
+        values = self.frame_statistics(statistics, progress_callback, cancel)
+
+        normalization = {
+            'intensity_raw': lambda: self.area,
+            'intensity_int': lambda: self.area * self.intensity(0),
+            'std_int': lambda: self.intensity(0)
+        }
+
+        for key in keys:
+            itype, name = GRAPH_STATISTICS[key]
+            self.graphs[key] = values[itype][name] / normalization[key]()
+
+        return 'done'
 
     def make_intensity_raw(self, progress_callback):
         # self.print('Processing raw intensity')
-        type_buffer = self.type
-        self.type = 'raw'
-        self.graphs['intensity_raw'] = self.apply_function(np.sum, progress_callback) / self.area
-        self.type = type_buffer
-        return 'done'
+        return self.make_graphs(['intensity_raw'], progress_callback)
 
     def make_intensity_int(self, progress_callback):
         # self.print('Processing int. intensity')
-        type_buffer = self.type
-        self.type = 'int'
-        self.graphs['intensity_int'] = self.apply_function(np.sum, progress_callback) / self.area / self.intensity(0)
-        self.type = type_buffer
-        return 'done'
+        return self.make_graphs(['intensity_int'], progress_callback)
 
     def make_std_int(self, progress_callback):
         # self.print('Processing int. std')
-        type_buffer = self.type
-        self.type = 'int'
-        self.graphs['std_int'] = self.apply_function(np.std, progress_callback) / self.intensity(0)
-        self.type = type_buffer
-        return 'done'
+        return self.make_graphs(['std_int'], progress_callback)
 
-    def make_correlation(self):
+    def make_correlation(self, progress_callback=None, cancel=None):
         time0 = time.time()
         if self.idea3d is None:
             raise Exception('No selected NP patter for the file {}'.format(self.file))
 
-        img_type = self.type
-        self.type = 'diff'
-
-        raw_diff = np.zeros(self.shape)
-        self._data_diff_std = []
+        if CORRELATION_CACHE_BYTES > 0:
+            key = self._correlation_key()
+            if self._load_correlation(key):
+                return
 
         self.print('Processing data for correlation')
 
-        for f in range(len(self)):
-            print('\r\t{}/ {}'.format(f + 1, len(self)), end='')
-            raw_diff[:, :, f] = self.frame(f)
-            self._data_diff_std.append(np.std(self.frame(f)))
-
-        print('\n')
+        diff_std = np.zeros(len(self))
 
-        self._data_corr = scipy.signal.correlate(
-            raw_diff,
-            self.idea3d,
-            mode='same'
-        ) * 1e5
+        def source(start, stop):
+            self._check_cancel(cancel)
+            block = self.frames(start, stop, 'diff')
+            diff_std[start: stop] = np.std(block, axis=(0, 1))
+            return block
 
-        self._data_corr_std = np.std(self._data_corr, axis=(0, 1))
-        self.type = img_type
+        correlator = Correlator(self.idea3d, self.shape_img, CORRELATION_CHUNK, self.dtype['work'])
+        if CORRELATION_PROCESSES == 1:
+            data_corr = correlator.correlate(source, len(self), progress_callback=progress_callback)
+        else:
+            data_corr = correlator.correlate_parallel(
+                source,
+                len(self),
+                processes=CORRELATION_PROCESSES,
+                progress_callback=progress_callback
+            )
+        data_corr *= 1e5
+        self._data_corr = data_corr
+        self._data_diff_std = list(diff_std)
+
+        self._data_corr_std = np.zeros(len(self))
+        for start in range(0, len(self), CHUNK_FRAMES):
+            self._data_corr_std[start: start + CHUNK_FRAMES] = np.std(
+                self._data_corr[:, :, start: start + CHUNK_FRAMES],
+                axis=(0, 1)
+            )
         self._range['corr'] = [- np.max(self._data_corr[:, :, self.k * 3:]),
                                np.max(self._data_corr[:, :, self.k * 3:])]
 
+        if CORRELATION_CACHE_BYTES > 0:
+            self._save_correlation(key)
+
         self.print('\n--elapsed time--\n{:.2f} s'.format(time.time() - time0))
 
     def histogram(self):
@@ -911,34 +1760,40 @@ class Core(object):
         return values, counts
 
     def frame_np(self, f):
-        positions = []
-        colors = []
-
-        for idnp in self.nps_in_frame[f]:
-            nnp = self.np_container[idnp]
-            positions.append(nnp.position(f))
-
-            if f == nnp.first_frame + len(nnp.positions)//2:
-                # colors.append(red)
-                colors.append(nnp.color)
-            else:
-                colors.append(nnp.color)
+        ids = self.nps_in_frame(f)
+        return self.np_container.positions(ids, f), self.np_container.colors(ids)
 
-
-        return positions, colors
+    def nps_in_frame(self, f):
+        return self.np_container.in_frame(f)
 
     def run_count_nps(self, start, stop, dpx):
-        self.np_container = []
-        self.nps_in_frame = [[] for i in range(len(self))]
-
-        self.count_nps(start, stop, dpx)
+        self.set_nps(self.count_nps(start, stop, dpx))
 
         # self.threshold_value *= -1
         # self.count_nps(start, stop, dpx)
         # self.threshold_value *= -1
 
-    def count_nps(self, start, stop, dpx, ):
-        if self.threshold_value > 0:
+    def set_nps(self, nps):
+        # nps: the result of count_nps
+        self.np_container, self._mask_points, graphs = nps
+        self.graphs.update(graphs)
+        self.show_nps = True
+
+    def count_nps(self, start, stop, dpx, cancel=None):
+        # the NPs are collected in locals and returned, the core is not changed, so it may run as a job while the
+        # current NPs are shown, the settings are read once at the start
+
+        k = self.k
+        threshold = self.threshold
+        settings = self._threshold_settings()
+        threshold_value = settings[0]
+        data_corr = self._data_corr
+        if threshold:
+            level = self._data_corr_std / np.average(self._data_corr_std[k * 3:])
+
+        np_container = NPTable()
+
+        if threshold_value > 0:
             color = green
             plot = 'nps_pos'
         else:
@@ -954,57 +1809,32 @@ class Core(object):
         # success = green
         # minor = black
 
-        def check_np(slice):
-            x0_np = np.array([
-                slice[0].start,
-                slice[1].start,
-                slice[2].start
-            ])
-            x1_np = np.array([
-                slice[0].stop,
-                slice[1].stop,
-                slice[2].stop
-            ])
-
-            # self.print('len {}'.format(5 > x1_np[2] - x0_np[2]))
-            # self.print('len {}'.format(x1_np[2] - x0_np[2]))
-
-            if self.k // 2 > x1_np[2] - x0_np[2]:
-                return duration
+        def check_np(i):
+            # self.print('len {}'.format(x1[i, 2] - x0[i, 2]))
 
-            amx_np = np.argmax(data_corr[slice])
-            amx_np = np.unravel_index([amx_np], data_corr[slice].shape)
-            mx_np = np.max(data_corr[slice][:, :, amx_np[2]])
+            if k // 2 > x1[i, 2] - x0[i, 2]:
+                return duration
 
-            # if mx_np > 2 * self.autocorrelation_max:
+            # if maxima[i] > 2 * self.autocorrelation_max:
             #     return bright_defect
 
             slice_extended = np.s_[
-                             x0_np[0] - dpx: x1_np[0] + dpx,
-                             x0_np[1] - dpx: x1_np[1] + dpx,
-                             x0_np[2]: x1_np[1]
+                             x0[i, 0] - dpx: x1[i, 0] + dpx,
+                             x0[i, 1] - dpx: x1[i, 1] + dpx,
+                             x0[i, 2]: x1[i, 1]
                              ]
 
-            data_np_labeled = data_labeled[slice_extended]
-
-            for npi in np.unique(data_np_labeled):
-                if npi - 1 in blacklist_npid or npi == 0:
+            for j in labels_in(slice_extended):
+                if blacklist[j]:
                     continue
 
-                amx_i = np.argmax(data_corr[np_slices[npi - 1]])
-                amx_i = np.unravel_index([amx_i], data_corr[np_slices[npi - 1]].shape)
-                mx_i = np.max(data_corr[np_slices[npi - 1]])
-
-                x0_i = np.array([
-                    np_slices[npi - 1][0].start,
-                    np_slices[npi - 1][1].start,
-                    np_slices[npi - 1][2].start,
-                ])
-
-                if np.abs(x0_i[2] + amx_i[2] - x0_np[2] - amx_np[2]) < dpx and mx_i < mx_np:
-                    blacklist_npid.append(npi - 1)
+                if np.abs(peaks[j, 2] - peaks[i, 2]) < dpx and maxima[j] < maxima[i]:
+                    blacklist[j] = True
                     continue
-                elif np.linalg.norm(x0_i + np.array(amx_i) - x0_np - np.array(amx_np)) <= 3 * dpx and mx_i > mx_np:
+                # the corners and the peak offsets broadcast to a (3, 3) array, as they always did
+                elif np.linalg.norm(
+                        x0[j] + amx[j][:, np.newaxis] - x0[i] - amx[i][:, np.newaxis]
+                ) <= 3 * dpx and maxima[j] > maxima[i]:
                     return minor
 
             return success
@@ -1012,62 +1842,91 @@ class Core(object):
         time0 = time.time()
         self.print('\nDetecting NPs')
 
-        self.graphs[plot] = np.array([0 for i in range(len(self))])
-        blacklist_npid = []
-
-        data_threshold = np.zeros(self.shape)
-        data_corr = np.zeros(self.shape)
-        self._data_mask = np.zeros(self.shape)
-
-        if start < self.k * 2:
-            start_p = self.k * 2
+        def data_threshold(a, b):
+            self._check_cancel(cancel)
+            block = np.moveaxis(data_corr[:, :, a: b], 2, 0)
+            if threshold:
+                block = self._threshold_block(block, level[a: b], settings)
+
+            block = np.moveaxis(block, 0, 2).astype(np.float64)
+            block[block > 0.1] = 1
+            return block.astype(np.uint8)
+
+        def labels_in(slice):
+            # components with a voxel within the slice, as np.unique(data_labeled[slice]) of the whole volume
+            box = np.array([s.indices(n)[:2] for s, n in zip(slice, self.shape)])
+            if np.any(box[:, 0] >= box[:, 1]):
+                return []
+
+            candidates = set()
+            for cx in range(box[0, 0] // NP_GRID, (box[0, 1] - 1) // NP_GRID + 1):
+                for cy in range(box[1, 0] // NP_GRID, (box[1, 1] - 1) // NP_GRID + 1):
+                    candidates.update(grid.get((cx, cy), []))
+
+            candidates = np.array(sorted(candidates), dtype=int)
+            candidates = candidates[np.all((x0[candidates] < box[:, 1]) & (x1[candidates] > box[:, 0]), axis=1)]
+            within = np.all((x0[candidates] >= box[:, 0]) & (x1[candidates] <= box[:, 1]), axis=1)
+
+            return [
+                j for j, w in zip(candidates, within)
+                if w or np.any(np.all((np_voxels[j] >= box[:, 0]) & (np_voxels[j] < box[:, 1]), axis=1))
+            ]
+
+        graph = np.array([0 for i in range(len(self))])
+        mask_points = []
+
+        if start < k * 2:
+            start_p = k * 2
         else:
             start_p = start
 
-        for f in range(start_p, stop):
-            data_threshold[:, :, f] = self.frame(f)
-
-        data_threshold[data_threshold > 0.1] = 1
-        data_threshold = data_threshold.astype(np.uint8)
-
-        if self.threshold_value > 0:
-            data_corr[:, :, start_p:stop] = self._data_corr[:, :, start_p:stop]
-        else:
-            data_corr[:, :, start_p:stop] = self._data_corr[:, :, start_p:stop] * -1
-
-        data_labeled, _ = ndimage.label(data_threshold, np.ones((3, 3, 3)))
-        np_slices = ndimage.find_objects(data_labeled)
-
-        for np_slice in np_slices:
-            idnp = len(self.np_container)
-            if check_np(np_slice):
+        # the frames are thresholded and labeled chunk by chunk, the labels are those of ndimage.label
+        np_slices, np_voxels = tl.label_chunks(data_threshold, start_p, stop, CHUNK_FRAMES)
+        x0 = np.array([[s.start for s in np_slice] for np_slice in np_slices], dtype=int).reshape(-1, 3)
+        x1 = np.array([[s.stop for s in np_slice] for np_slice in np_slices], dtype=int).reshape(-1, 3)
+        blacklist = np.zeros(len(np_slices), dtype=bool)
+
+        # the maximum of the correlation within the bounding box of every component and its position
+        amx = np.zeros((len(np_slices), 3), dtype=int)
+        maxima = np.zeros(len(np_slices), dtype=self.dtype['work'])
+        for i, np_slice in enumerate(np_slices):
+            if threshold_value > 0:
+                corr = data_corr[np_slice]
+            else:
+                corr = data_corr[np_slice] * -1
+
+            amx[i] = np.unravel_index(np.argmax(corr), corr.shape)
+            maxima[i] = corr[tuple(amx[i])]
+        peaks = x0 + amx
+
+        # bounding boxes of the components in the cells of NP_GRID x NP_GRID px
+        grid = dict()
+        for i in range(len(np_slices)):
+            for cx in range(x0[i, 0] // NP_GRID, (x1[i, 0] - 1) // NP_GRID + 1):
+                for cy in range(x0[i, 1] // NP_GRID, (x1[i, 1] - 1) // NP_GRID + 1):
+                    grid.setdefault((cx, cy), []).append(i)
+
+        for npi, np_slice in enumerate(np_slices):
+            idnp = len(np_container)
+            if check_np(npi):
                 x = (np_slice[0].start + np_slice[0].stop) / 2
                 y = (np_slice[1].start + np_slice[1].stop) / 2
 
                 dt = int(np_slice[2].stop - np_slice[2].start)
 
-                nnp = NanoParticle(idnp, np_slice[2].start, [np.array([x, y])] * dt, positive=self.threshold_value > 0)
-                nnp.color = color
+                nnp = np_container.append(x, y, np_slice[2].start, dt, threshold_value > 0, color)
                 # nnp.color = check_np(np_slice)
 
-                if idnp in blacklist_npid:
+                if idnp < len(blacklist) and blacklist[idnp]:
                     nnp.color = yellow
 
-                self.np_container.append(nnp)
-
                 if self._mask_ommit[int(x), int(y)]:
                     nnp.color = red
                 else:
-                    self.graphs[plot][np_slice[2].start] += 1
-                    self._data_mask[int(x), int(y), int(np_slice[2].start):] = 1
-
-                for i in range(dt):
-                    self.nps_in_frame[np_slice[2].start + i].append(idnp)
+                    graph[np_slice[2].start] += 1
+                    mask_points.append([int(x), int(y), int(np_slice[2].start)])
             # else:
-            #     self.np_container.append(None)
-
-        # self._data_mask = data_threshold
-        self.show_nps = True
+            #     np_container.append(None)
 
         self.print('\n--elapsed time--\n{:.2f} s'.format(time.time() - time0))
-        return
+        return np_container, np.array(mask_points, dtype=int).reshape(-1, 3), {plot: graph}
@@ -0,0 +1,172 @@
+import hashlib
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ALL_COMPLETED, FIRST_COMPLETED, wait
+
+import numpy as np
+import scipy.fft
+
+# the pool of processes shared by all Correlator.correlate_parallel calls (all channels) and the chunks in flight
+# over all of them
+_pool = None
+_in_flight = None
+_pool_lock = threading.Lock()
+
+# correlators of a worker process by the key of their kernel, the last few are kept
+_worker = dict()
+WORKER_CORRELATORS = 4
+
+
+def _shared_pool(processes):
+    # the pool is created by the first call, with its number of processes
+    global _pool, _in_flight
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=processes)
+            _in_flight = threading.Semaphore(2 * processes)
+        return _pool, _in_flight
+
+
+def _worker_slab(key, kernel, shape_img, chunk, dtype, slab, n):
+    if key not in _worker:
+        if len(_worker) >= WORKER_CORRELATORS:
+            _worker.clear()
+        _worker[key] = Correlator(kernel, shape_img, chunk, dtype)
+
+    return np.ascontiguousarray(_worker[key].correlate_slab(slab, n))
+
+
+class Correlator(object):
+    # correlation of a video with a 3D pattern, scipy.signal.correlate(video, kernel, mode='same'),
+    # computed by overlap-save along the time axis, the FFT of the kernel is computed once for all chunks
+    def __init__(self, kernel, shape_img, chunk, dtype=np.float64):
+        self.dtype = np.dtype(dtype)
+        self.kernel = np.asarray(kernel, dtype=self.dtype)
+        self.shape_img = tuple(shape_img)
+        self.chunk = chunk
+
+        kh, kw, kt = self.kernel.shape
+        self.shape_fft = (self.shape_img[0] + kh - 1, self.shape_img[1] + kw - 1, chunk + kt - 1)
+
+        # the offsets of the mode 'same' within the full correlation
+        self.offset = ((kh - 1) // 2, (kw - 1) // 2, (kt - 1) // 2)
+
+        # correlation is the convolution with the reversed kernel
+        self.kernel_fft = scipy.fft.rfftn(self.kernel[::-1, ::-1, ::-1], self.shape_fft)
+
+    @property
+    def overlap(self):
+        return self.kernel.shape[2] - 1
+
+    def slab_range(self, start, stop):
+        # input frames needed for the output frames [start, stop)
+        first = start + self.offset[2] - self.overlap
+        return first, first + stop - start + self.overlap
+
+    def correlate_slab(self, slab, n):
+        # slab: input frames slab_range(start, start + n), zeros outside the video, returns n output frames
+        spectrum = scipy.fft.rfftn(slab, self.shape_fft)
+        spectrum *= self.kernel_fft
+        full = scipy.fft.irfftn(spectrum, self.shape_fft)
+
+        oh, ow, _ = self.offset
+        return full[
+               oh: oh + self.shape_img[0],
+               ow: ow + self.shape_img[1],
+               self.overlap: self.overlap + n
+               ]
+
+    def slabs(self, source, length):
+        # yields start, stop and the input slab of the output frames [start, stop), the slab is reused
+        slab = np.zeros(self.shape_img + (self.chunk + self.overlap,), dtype=self.dtype)
+
+        for start in range(0, length, self.chunk):
+            stop = min(start + self.chunk, length)
+            first, last = self.slab_range(start, stop)
+
+            # the overlap of the previous slab is reused
+            reuse = self.overlap if start > 0 else 0
+            slab[:, :, :reuse] = slab[:, :, self.chunk: self.chunk + reuse]
+            slab[:, :, reuse:] = 0
+
+            new_first = max(first + reuse, 0)
+            new_last = min(last, length)
+            if new_first < new_last:
+                slab[:, :, new_first - first: new_last - first] = source(new_first, new_last)
+
+            yield start, stop, slab
+
+    def correlate(self, source, length, out=None, progress_callback=None):
+        # source(start, stop) returns the frames [start, stop) of the video, 0 <= start < stop <= length,
+        # every frame is requested once
+        if out is None:
+            out = np.zeros(self.shape_img + (length,), dtype=self.dtype)
+
+        for start, stop, slab in self.slabs(source, length):
+            out[:, :, start: stop] = self.correlate_slab(slab, stop - start)
+
+            if progress_callback is not None:
+                progress_callback.emit(stop / length * 100)
+
+        return out
+
+    def correlate_parallel(self, source, length, out=None, processes=None, progress_callback=None):
+        # the slabs are streamed to the pool of processes shared by all calls, at most 2 * processes chunks are in
+        # flight over all calls (channels correlated at once), so the memory is bounded by the chunk size as in
+        # correlate
+        if processes is None:
+            processes = os.cpu_count()
+
+        if out is None:
+            out = np.zeros(self.shape_img + (length,), dtype=self.dtype)
+
+        pool, in_flight = _shared_pool(processes)
+        key = hashlib.sha1(
+            repr((self.kernel.shape, self.shape_img, self.chunk, str(self.dtype))).encode() + self.kernel.tobytes()
+        ).hexdigest()
+
+        running = dict()
+        done = 0
+
+        def collect(return_when, timeout=None):
+            # a chunk stays in flight until its result is written to out
+            nonlocal done
+            finished, _ = wait(running, timeout, return_when)
+            for future in finished:
+                start, stop = running.pop(future)
+                try:
+                    out[:, :, start: stop] = future.result()
+                finally:
+                    in_flight.release()
+                done += stop - start
+
+                if progress_callback is not None:
+                    progress_callback.emit(done / length * 100)
+
+        try:
+            for start, stop, slab in self.slabs(source, length):
+                # the own finished chunks are collected while waiting for a free place
+                while not in_flight.acquire(timeout=0.1):
+                    collect(FIRST_COMPLETED, 0)
+
+                running[pool.submit(
+                    _worker_slab,
+                    key,
+                    self.kernel,
+                    self.shape_img,
+                    self.chunk,
+                    self.dtype,
+                    np.array(slab),
+                    stop - start
+                )] = (start, stop)
+
+            collect(ALL_COMPLETED)
+
+        finally:
+            for future in running:
+                future.cancel()
+            wait(running)
+            for future in running:
+                in_flight.release()
+
+        return out
@@ -0,0 +1,59 @@
+import collections
+import threading
+
+
+class FrameCache(object):
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+        self._frames = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._frames)
+
+    def __contains__(self, key):
+        return key in self._frames
+
+    def get(self, key):
+        with self._lock:
+            try:
+                image = self._frames[key]
+            except KeyError:
+                self.misses += 1
+                return None
+
+            self._frames.move_to_end(key)
+            self.hits += 1
+            return image
+
+    def put(self, key, image):
+        if image.nbytes > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._frames:
+                self.bytes -= self._frames.pop(key).nbytes
+
+            self._frames[key] = image
+            self.bytes += image.nbytes
+
+            while self.bytes > self.max_bytes:
+                _, oldest = self._frames.popitem(last=False)
+                self.bytes -= oldest.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._frames.clear()
+            self.bytes = 0
+
+    def info(self):
+        return 'frames: {}, {:.1f} MB, hits: {}, misses: {}'.format(
+            len(self._frames),
+            self.bytes / 2 ** 20,
+            self.hits,
+            self.misses
+        )
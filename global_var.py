@@ -5,6 +5,7 @@ FOLDER_IDEAS = 'ideas'
 FOLDER_BIOEXPORTS = '/exports_bio'
 FOLDER_SAVED = 'saved_data'
 FOLDER_NP_IMAGES = 'exports_np_images'
+FOLDER_CACHE = 'cache'
 
 NAME_RAW = 'raw'
 NAME_LOCAL_SPR = 'spr'
@@ -19,6 +20,82 @@ INIT_FOUR = [-50, 50]
 PX = 2.93e-3 #mm
 PX_DEPTH = 32700
 
+# number of frames processed at once by the chunked computations
+CHUNK_FRAMES = 64
+
+# output frames of one chunk of the correlation, the FFT buffers hold (h + kh) * (w + kw) * (chunk + kt) values
+CORRELATION_CHUNK = 64
+# processes correlating the chunks, None uses all cores, 1 correlates the chunks in the calling process, the
+# processes are shared by all channels, the chunks are streamed to them, at most 2 per process are held in memory
+# over all channels
+CORRELATION_PROCESSES = None
+
+# disk space of the correlations and the downsampled videos cached in FOLDER_CACHE (least recently used are
+# removed), 0 disables the cache of the correlations
+CORRELATION_CACHE_BYTES = 8 * 2 ** 30
+
+# NPs cut out and fitted at once by np_analysis, and the processes fitting them (None uses all cores)
+NP_FIT_BATCH = 256
+NP_FIT_PROCESSES = None
+
+# context around a region of interest for the local filters [px], filters acting on the whole spectrum need
+# the full frame
+ROI_MARGIN = 16
+FILTERS_GLOBAL = ['a_fourier']
+FULL_FRAME = (slice(None), slice(None))
+
+# surroundings of a NP in the exported traces (2 * size + 1 px square), frames before and after its first
+# frame, and the (NP, frame) pairs cut out at once
+NP_TRACE_SIZE = 15
+NP_TRACE_FRAMES = 32
+NP_TRACE_BATCH = 4096
+
+# the frame type and the statistic of every frame behind a graph of Core.graphs
+GRAPH_STATISTICS = {
+    'intensity_raw': ('raw', 'sum'),
+    'intensity_int': ('int', 'sum'),
+    'std_int': ('int', 'std')
+}
+
+# cell of the spatial index of the detected components in count_nps [px]
+NP_GRID = 16
+
+# memory for the processed frames kept by every core (LRU)
+FRAME_CACHE_BYTES = 256 * 2 ** 20
+
+# Core.downsample: 'decimate' (scipy.signal.decimate, anti-aliasing filter) or 'mean' (averages of the blocks
+# of frames, cheaper)
+DOWNSAMPLE_MODE = 'decimate'
+
+# playback: speed relative to the acquisition (_time_info), the highest rate of the displayed frames [fps]
+# and the frames computed ahead of the playback
+PLAYBACK_SPEED = 1
+PLAYBACK_FPS = 30
+PLAYBACK_AHEAD = 8
+
+# threads computing the chunks of Core.apply_function and Core.frame_statistics (None uses all cores)
+APPLY_WORKERS = None
+
+# frames computed ahead in the direction of navigation, and the threads computing them
+PREFETCH_FRAMES = 4
+PREFETCH_WORKERS = 2
+
+# chunk of the prefix-sum accumulator, its local sums are kept in the working type, with float32 the error
+# of the diff/int images grows with the chunk: up to ~2e-6 at k = 1 (raw ~0.5), decreasing with k
+ACCUMULATOR_CHUNK = 32
+
+# storage types of the raw video, of the derived volumes (diff, correlation) and of the masks
+# 'float64' reproduces the original outputs exactly
+# 'float32' differs by up to ~1.5e-7 absolute in the diff/int images (~3e-7 relative to a raw intensity of ~0.5),
+#   up to ~2e-6 with the float32 local sums of the accumulator (ACCUMULATOR_CHUNK)
+# 'uint16' stores the raw data as counts of PX_DEPTH, the rounding error is below 0.5 / PX_DEPTH = 1.5e-5 per
+#   raw px (up to 3.1e-5 in the diff/int images, ~0.4 % of INIT_RANGE), the masks are bit-packed
+DTYPE_POLICIES = {
+    'float64': {'raw': 'float64', 'work': 'float64', 'mask': 'float64'},
+    'float32': {'raw': 'float32', 'work': 'float32', 'mask': 'uint8'},
+    'uint16': {'raw': 'uint16', 'work': 'float32', 'mask': 'packed'},
+}
+
 # LMIN, LMAX = [0, -1]
 # SMIN, SMAX = [0, -1]
 #vertical
@@ -70,6 +147,8 @@ Mouse scrolling moves the time
 'alt + 4' shows positions of all the detected NPs
 'i' sets the current frame as a reference for the integral image
 'f' turns on/off all the filters
+'space' plays/pauses the video in real time, '+' and '-' double or halve the speed of the playback
+    (the frames not computed in time are skipped, the achieved fps and the skipped frames are shown in the title)
 
 The shortcuts work locally for the active channel (mouse within its area) or globally for all the channels (mouse outside any channel).
 
@@ -1,9 +1,11 @@
 import collections
 import copy
 import json
+import multiprocessing
 import sys
 import os
 import re
+import threading
 import time
 import traceback
 
@@ -62,6 +64,102 @@ class Worker(QRunnable):
             self.signals.finished.emit()
 
 
+class Job(object):
+    # a long operation on the thread pool, one worker per channel, with its own progress bar and cancel button in
+    # the status bar, done(job) is called on the main thread after all its workers finish, the functions of a
+    # cancellable job get the cancel event of the job (only this job is stopped by its cancel button)
+    def __init__(self, main_window, name, fns, done=None, cancel=True, progress=True, buttons=()):
+        self.main_window = main_window
+        self.fns = fns
+        self.done = done
+        self.cancel_event = threading.Event() if cancel else None
+        self.buttons = buttons
+
+        self.results = [None for fn in fns]
+        self.errors = []
+        self.progress = [0 for fn in fns]
+        self.running = 0
+        self.cancelled = False
+
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setMaximumWidth(200)
+        if not progress:
+            # busy indicator
+            self.progress_bar.setRange(0, 0)
+
+        self.button_cancel = QPushButton('Cancel')
+        self.button_cancel.clicked.connect(self.cancel)
+        self.button_cancel.setDisabled(not cancel)
+
+        layout = QHBoxLayout()
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.addWidget(QLabel(name))
+        layout.addWidget(self.progress_bar)
+        layout.addWidget(self.button_cancel)
+
+        self.widget = QWidget()
+        self.widget.setLayout(layout)
+
+    @property
+    def failed(self):
+        return self.cancelled or len(self.errors) != 0
+
+    def start(self):
+        for button in self.buttons:
+            button.setDisabled(True)
+        self.main_window.statusBar().addPermanentWidget(self.widget)
+
+        # the workers of all jobs run at once, the heavy work is done by the pools of the cores
+        threadpool = self.main_window.threadpool
+        threadpool.setMaxThreadCount(max(threadpool.maxThreadCount(), threadpool.activeThreadCount() + len(self.fns)))
+
+        self.running = len(self.fns)
+        for i, fn in enumerate(self.fns):
+            if self.cancel_event is None:
+                worker = Worker(fn)
+            else:
+                worker = Worker(fn, cancel=self.cancel_event)
+            worker.signals.progress.connect(lambda n, i=i: self.set_progress(i, n))
+            worker.signals.result.connect(lambda result, i=i: self.set_result(i, result))
+            worker.signals.error.connect(self.errors.append)
+            worker.signals.finished.connect(self.finished)
+            threadpool.start(worker)
+
+        if len(self.fns) == 0:
+            self.running = 1
+            self.finished()
+
+    def set_progress(self, i, n):
+        # the average over the channels
+        self.progress[i] = n
+        self.progress_bar.setValue(int(sum(self.progress) / len(self.progress)))
+
+    def set_result(self, i, result):
+        self.results[i] = result
+
+    def cancel(self):
+        self.cancelled = True
+        self.button_cancel.setDisabled(True)
+        self.cancel_event.set()
+
+    def finished(self):
+        self.running -= 1
+        if self.running != 0:
+            return
+
+        self.main_window.statusBar().removeWidget(self.widget)
+        self.widget.deleteLater()
+        for button in self.buttons:
+            button.setDisabled(False)
+        self.main_window.jobs.remove(self)
+
+        if len(self.errors) != 0 and not self.cancelled:
+            OKDialog('Error catched', '\n'.join(str(error[1]) for error in self.errors))
+
+        if self.done is not None:
+            self.done(self)
+
+
 class MainWindow(QMainWindow):
 
     def __init__(self, *args, **kwargs):
@@ -87,6 +185,9 @@ class MainWindow(QMainWindow):
         self.loading_window = None
         self.threadpool = QThreadPool()
 
+        # the running jobs
+        self.jobs = []
+
         min_label_width = 150
         min_value_width = 50
 
@@ -117,6 +218,23 @@ class MainWindow(QMainWindow):
         self.crop_checkbox = QCheckBox('Crop')
         self.crop_checkbox.setChecked(True)
 
+        self.mmap_checkbox = QCheckBox('Memory-map')
+        self.mmap_checkbox.setStatusTip('Reads the frames from the disk on demand. Use for files larger than RAM.')
+
+        self.cache_checkbox = QCheckBox('Frame cache')
+        self.cache_checkbox.setStatusTip(
+            'Converts the raw data once into a frame-contiguous cache. An existing cache is always used.')
+
+        self.accumulator_checkbox = QCheckBox('Prefix sums')
+        self.accumulator_checkbox.setStatusTip(
+            'Precomputes sums in time, the integration then takes the same time for any number of frames.')
+
+        self.dtype_box = QComboBox()
+        self.dtype_box.setStatusTip(
+            'Storage type of the data. float32 and uint16 need 2-4x less memory, see global_var for the precision.')
+        for dtype in gv.DTYPE_POLICIES:
+            self.dtype_box.addItem(dtype)
+
         self.channel_checkbox_list = []
         for i in range(1, 5):
             self.channel_checkbox_list.append(QCheckBox('channel {}'.format(i)))
@@ -285,11 +403,6 @@ class MainWindow(QMainWindow):
         self.line_export_stop.setText('100')
         self.line_export_stop.textChanged.connect(self.RefreshExportRange)
 
-        self.progress_bar = QProgressBar(self)
-        self.progress_bar.setGeometry(200, 80, 250, 20)
-        self.progress_bar.setVisible(False)
-        # self.progress_bar.setValue(50)
-
         self.exim_buttons = [
             self.button_export,
             self.button_export_csv,
@@ -427,7 +540,18 @@ class MainWindow(QMainWindow):
         layout_orientation.addWidget(self.transpose_checkbox)
         layout.addLayout(layout_orientation)
 
-        layout.addWidget(self.crop_checkbox)
+        layout_loading = QHBoxLayout()
+        layout_loading.addWidget(self.crop_checkbox)
+        layout_loading.addWidget(self.mmap_checkbox)
+        layout_loading.addWidget(self.cache_checkbox)
+        layout.addLayout(layout_loading)
+
+        layout_dtype = QHBoxLayout()
+        layout_dtype.addWidget(QLabel('Data type'))
+        layout_dtype.addWidget(self.dtype_box)
+        layout_dtype.addWidget(self.accumulator_checkbox)
+        layout_dtype.addStretch(1)
+        layout.addLayout(layout_dtype)
 
         layout.addLayout(gw.layout_slider(
             QLabel('Downsample'),
@@ -599,7 +723,6 @@ class MainWindow(QMainWindow):
         layout.addWidget(self.button_count)
 
         layout.addWidget(self.info)
-        layout.addWidget(self.progress_bar)
 
         layout.addStretch(1)
         Tab.setLayout(layout)
@@ -709,7 +832,7 @@ class MainWindow(QMainWindow):
     def np_info_create(self):
         if self.view == None:
             text = 'Info will be displayed after image data processing.'
-        elif self.view.core_list[0].np_container != []:
+        elif len(self.view.core_list[0].np_container) != 0:
             text = str()
 
             for core in self.view.core_list:
@@ -728,7 +851,7 @@ class MainWindow(QMainWindow):
                     sum(core.graphs['nps_pos']) / core.active_area / gv.PX ** 2)
                 text += '\t' + '-' * 27 + '\n'
 
-                text += '\tpresent: {}\n'.format(len(core.nps_in_frame[self.view.f]))
+                text += '\tpresent: {}\n'.format(core.np_container.count(self.view.f, self.view.f + 1))
 
                 text += '\tcurrently adsorbed: {}\n'.format(core.graphs['nps_pos'][self.view.f])
                 # text += '\tcurrently dedsorbed: {}\n'.format(core.graphs['nps_neg'][self.view.f])
@@ -797,6 +920,11 @@ class MainWindow(QMainWindow):
         for c, w, h in zip(self.channels, self.width, self.height):
             fi += '{} \t{} \t{}\n'.format(c, w, h)
 
+        if self.view is not None:
+            fi += '\n'
+            for core in self.view.core_list:
+                fi += 'frame cache {}: {}\n'.format(core.file[-1], core.frame_cache.info())
+
         OKDialog('file info', fi, self)
 
     def RefreshNPInfo(self):
@@ -941,11 +1069,11 @@ class MainWindow(QMainWindow):
             info.setText(str(slider.value() / 10))
 
     def RunFilterGaussian(self):
-        fn = lambda img: gaussian_filter(img, self.slider_gauss.value() / 10)
+        fn = lambda img, sigma=self.slider_gauss.value() / 10: gaussian_filter(img, sigma)
         self.RunFilter(self.filter_gauss_checkbox.isChecked(), 'c_gauss', fn)
 
     def RunFilterFourier(self):
-        fn = lambda img: tl.fourier_filter_threshold(img, self.slider_fourier.value() - 200)
+        fn = lambda img, level=self.slider_fourier.value() - 200: tl.fourier_filter_threshold(img, level)
         self.RunFilter(self.filter_fourier_checkbox.isChecked(), 'a_fourier', fn)
 
     def RunFilterThreshold(self):
@@ -958,18 +1086,19 @@ class MainWindow(QMainWindow):
             self.view.canvas_img.next_frame(0)
 
     def RunFilterBilateral(self):
-        fn = lambda img: cv2.bilateralFilter(np.float32(img), int(self.slider_bilateral_d.value()),
-                                             10 ** (self.slider_bilateral_color.value() / 10 - 5),
-                                             self.slider_bilateral_space.value() / 10)
+        # the parameters are bound as default arguments, the filters are identified by their values
+        d = int(self.slider_bilateral_d.value())
+        color = 10 ** (self.slider_bilateral_color.value() / 10 - 5)
+        space = self.slider_bilateral_space.value() / 10
+        fn = lambda img, d=d, color=color, space=space: cv2.bilateralFilter(np.float32(img), d, color, space)
         self.RunFilter(self.filter_bilateral_checkbox.isChecked(), 'b_bilateral', fn)
 
     def RunFilterWiener(self):
         if self.slider_wiener_noise_info.text() == 'auto':
-            fn = lambda img: scipy.signal.wiener(img, self.slider_wiener.value())
+            fn = lambda img, size=self.slider_wiener.value(): scipy.signal.wiener(img, size)
         else:
-            fn = lambda img: scipy.signal.wiener(img, self.slider_wiener.value(),
-                                                 10 ** (self.slider_wiener_noise.value() / 100 - 8)
-                                                 )
+            noise = 10 ** (self.slider_wiener_noise.value() / 100 - 8)
+            fn = lambda img, size=self.slider_wiener.value(), noise=noise: scipy.signal.wiener(img, size, noise)
         self.RunFilter(self.filter_wiener_checkbox.isChecked(), 'a_wiener', fn)
 
     def RunFilterAbsolute(self):
@@ -1004,6 +1133,10 @@ class MainWindow(QMainWindow):
                 'orientation_checkbox': self.orientation_checkbox.isChecked(),
                 'transpose_checkbox': self.transpose_checkbox.isChecked(),
                 'crop_checkbox': self.crop_checkbox.isChecked(),
+                'mmap_checkbox': self.mmap_checkbox.isChecked(),
+                'cache_checkbox': self.cache_checkbox.isChecked(),
+                'dtype_box': self.dtype_box.currentText(),
+                'accumulator_checkbox': self.accumulator_checkbox.isChecked(),
                 'slider_downsample': self.slider_downsample.value(),
                 'slider_k': self.slider_k.value(),
                 'filters_checkbox': self.filters_checkbox.isChecked(),
@@ -1043,6 +1176,19 @@ class MainWindow(QMainWindow):
                 self.orientation_checkbox.setChecked(p['orientation_checkbox'])
                 self.transpose_checkbox.setChecked(p['transpose_checkbox'])
                 self.crop_checkbox.setChecked(p['crop_checkbox']),
+
+                if 'mmap_checkbox' in p.keys():
+                    self.mmap_checkbox.setChecked(p['mmap_checkbox'])
+
+                if 'cache_checkbox' in p.keys():
+                    self.cache_checkbox.setChecked(p['cache_checkbox'])
+
+                if 'dtype_box' in p.keys():
+                    self.dtype_box.setCurrentText(p['dtype_box'])
+
+                if 'accumulator_checkbox' in p.keys():
+                    self.accumulator_checkbox.setChecked(p['accumulator_checkbox'])
+
                 self.slider_downsample.setValue(p['slider_downsample'])
                 self.slider_k.setValue(p['slider_k'])
                 self.filter_wiener_checkbox.setChecked(p['filter_wiener_checkbox'])
@@ -1087,9 +1233,26 @@ class MainWindow(QMainWindow):
         self.view.set_range()
         self.view.canvas_img.next_frame(0)
 
+    def run_job(self, name, fns, done=None, cancel=True, progress=True, buttons=()):
+        # fns: one function per channel, called with the progress_callback and the cancel event (if cancel)
+        job = Job(self, name, fns, done, cancel, progress, buttons)
+        self.jobs.append(job)
+        job.start()
+        return job
+
     def CorrelateButtonClick(self):
-        for core in self.view.core_list:
-            core.make_correlation()
+        self.run_job(
+            'Correlation',
+            [lambda progress_callback, cancel, core=core: core.make_correlation(progress_callback, cancel) for core in
+             self.view.core_list],
+            self.correlation_complete,
+            buttons=[self.button_correlate]
+        )
+
+    def correlation_complete(self, job):
+        if job.failed:
+            return
+
         self.view.change_type(None, 'corr')
         self.view.set_range()
         self.view.canvas_img.next_frame(0)
@@ -1108,8 +1271,28 @@ class MainWindow(QMainWindow):
                 self.filter_threshold_checkbox.setChecked(True)
                 core.threshold = True
 
-            core.run_count_nps(int(self.line_count_start.text()), int(self.line_count_stop.text()),
-                               self.slider_distance.value())
+        start = int(self.line_count_start.text())
+        stop = int(self.line_count_stop.text())
+        dpx = self.slider_distance.value()
+
+        self.run_job(
+            'Counting NPs',
+            [lambda progress_callback, cancel, core=core: core.count_nps(start, stop, dpx, cancel) for core in
+             self.view.core_list],
+            self.count_complete,
+            progress=False,
+            buttons=[self.button_count]
+        )
+
+    def count_complete(self, job):
+        if job.failed:
+            return
+
+        # the NPs found by the workers replace the shown ones here, on the main thread
+        for core, nps in zip(self.view.core_list, job.results):
+            core.set_nps(nps)
+
+        for core in self.view.core_list:
             # core.type = 'diff'
             self.filters_checkbox.setChecked(False)
             core.postprocessing = False
@@ -1139,8 +1322,16 @@ class MainWindow(QMainWindow):
         OKDialog('Message', 'Sorry, not implemented yet.', self)
 
     def ExportButtonClick(self):
-        for core in self.view.core_list:
-            core.export_data(int(self.line_export_start.text()), int(self.line_export_stop.text()))
+        start = int(self.line_export_start.text())
+        stop = int(self.line_export_stop.text())
+
+        self.run_job(
+            'Export',
+            [lambda progress_callback, core=core: core.export_data(start, stop) for core in self.view.core_list],
+            cancel=False,
+            progress=False,
+            buttons=[self.button_export]
+        )
 
     def ExportCSVButtonClick(self):
         if self.view.core_list[0].np_container is not None:
@@ -1160,22 +1351,50 @@ class MainWindow(QMainWindow):
 
     def AnalyseNPsButtonClick(self):
         if self.view.core_list[0].np_container is not None:
-            for core in self.view.core_list:
-                core.np_analysis()
+            # the NPs are cut out of the frames of the type shown when the job starts, their traces are exported
+            self.run_job(
+                'NP analysis',
+                [lambda progress_callback, cancel, core=core, itype=core.type: core.np_analysis(
+                    progress_callback,
+                    cancel,
+                    itype,
+                    traces=True
+                ) for core in self.view.core_list],
+                self.np_analysis_complete,
+                buttons=[self.button_analyse_nps]
+            )
+
+    def np_analysis_complete(self, job):
+        # the colors of the analysed NPs are set here, on the main thread, the failed channels have no result
+        for core, analysis in zip(self.view.core_list, job.results):
+            if analysis is not None:
+                core.set_np_colors(analysis)
+
+        self.view.next_frame(0)
 
     def ExportGIFButtonClick(self):
         start = int(self.line_export_start.text())
         stop = int(self.line_export_stop.text())
         speed = float(self.line_export_speed.text())
 
-        self.view.canvas_img.save_gif(start, stop, speed, True)
+        self.run_job(
+            'GIF',
+            [lambda progress_callback: self.view.canvas_img.save_gif(start, stop, speed, True, progress_callback)],
+            cancel=False,
+            buttons=[self.button_export_gif]
+        )
 
     def ExportVideoButtonClick(self):
         start = int(self.line_export_start.text())
         stop = int(self.line_export_stop.text())
         speed = float(self.line_export_speed.text())
 
-        self.view.canvas_img.save_gif(start, stop, speed, False)
+        self.run_job(
+            'Video',
+            [lambda progress_callback: self.view.canvas_img.save_gif(start, stop, speed, False, progress_callback)],
+            cancel=False,
+            buttons=[self.button_export_video]
+        )
 
     def ImportNPsButtonClick(self):
         if self.view.core_list[0].np_container is not None:
@@ -1227,29 +1446,28 @@ class MainWindow(QMainWindow):
             for chch in self.channel_checkbox_list:
                 chch.setChecked(False)
 
-    def progress_fn(self, n):
-        self.progress_bar.setValue(n)
+    def thread_complete(self, job=None):
+        # the graphs of the cancelled jobs are missing
+        if job is not None and job.failed:
+            self.chosen_plots = [False for p in self.chosen_plots]
 
-    def thread_complete(self):
-        if self.threadpool.activeThreadCount() == 0:
-            if True in self.chosen_plots and self.view.core_list[0].spr_time is not None:
-                canvas_plot = self.view.show_plots(self.chosen_plots)
-                canvas_plot.main_window = self
+        if True in self.chosen_plots and self.view.core_list[0].spr_time is not None:
+            canvas_plot = self.view.show_plots(self.chosen_plots)
+            canvas_plot.main_window = self
 
-                self.plot_window = PlotWindow(canvas_plot)
-                self.plot_window.show()
+            self.plot_window = PlotWindow(canvas_plot)
+            self.plot_window.show()
 
-                canvas_plot.setFocusPolicy(QtCore.Qt.ClickFocus)
-                canvas_plot.setFocus()
+            canvas_plot.setFocusPolicy(QtCore.Qt.ClickFocus)
+            canvas_plot.setFocus()
 
-            canvas_img = self.view.show_img()
-            canvas_img.main_window = self
-            self.img_window = PlotWindow(canvas_img)
-            self.img_window.show()
+        canvas_img = self.view.show_img()
+        canvas_img.main_window = self
+        self.img_window = PlotWindow(canvas_img)
+        self.img_window.show()
 
-            canvas_img.setFocusPolicy(QtCore.Qt.ClickFocus)
-            canvas_img.setFocus()
-            self.progress_bar.setVisible(False)
+        canvas_img.setFocusPolicy(QtCore.Qt.ClickFocus)
+        canvas_img.setFocus()
 
     def FourierButtonClick(self):
         if self.button_fourier.text() == 'Select':
@@ -1274,10 +1492,15 @@ class MainWindow(QMainWindow):
         self.view.next_frame(0)
 
     def DefectsRemoveButtonClick(self):
-        for core in self.view.core_list:
-            core.defects_removal(float(self.slider_defects_info.text()))
-
-        self.view.next_frame(0)
+        level = float(self.slider_defects_info.text())
+
+        self.run_job(
+            'Defects',
+            [lambda progress_callback, cancel, core=core: core.defects_removal(level, progress_callback, cancel)
+             for core in self.view.core_list],
+            lambda job: self.view.next_frame(0),
+            buttons=[self.button_defects_run]
+        )
 
     def OmmitButtonClick(self):
         if self.button_ommit.text() == 'Select':
@@ -1328,7 +1551,13 @@ class MainWindow(QMainWindow):
                 self.ommit_box.addItem('ch. {}'.format(i + 1))
                 self.select_box.addItem('ch. {}'.format(i + 1))
 
-                core = Core(self.folder, self.file + '_{}'.format(i + 1))
+                core = Core(
+                    self.folder,
+                    self.file + '_{}'.format(i + 1),
+                    tl.BoolFromCheckBox(self.mmap_checkbox),
+                    tl.BoolFromCheckBox(self.cache_checkbox),
+                    self.dtype_box.currentText()
+                )
 
                 self.view_cb_list[i].setDisabled(False)
                 self.view_cb_list[i].setObjectName(str(num_of_channel))
@@ -1339,13 +1568,18 @@ class MainWindow(QMainWindow):
                     core.ref_frame = 0
 
                 if tl.BoolFromCheckBox(self.transpose_checkbox):
-                    core._data_raw = np.swapaxes(core._data_raw, 0, 1)
+                    core.transpose()
                     core.ref_frame = 0
 
                 core._mask_ommit = np.zeros(core.shape_img)
 
                 core.k = self.slider_k.value()
-                core.downsample(self.slider_downsample.value())
+                # without downsampling the (memory mapped) data are used as they are
+                if self.slider_downsample.value() > 1:
+                    core.downsample(self.slider_downsample.value())
+
+                if tl.BoolFromCheckBox(self.accumulator_checkbox):
+                    core.build_accumulator(gv.ACCUMULATOR_CHUNK)
 
                 core.noise_analysis(self.avg * self.slider_downsample.value())
 
@@ -1365,8 +1599,6 @@ class MainWindow(QMainWindow):
             False
         ]
 
-        self.progress_bar.setVisible(True)
-
         for item in self.forms_image_filters + [self.filters_checkbox, self.line_count_stop, self.line_count_start]:
             item.setDisabled(False)
 
@@ -1387,28 +1619,27 @@ class MainWindow(QMainWindow):
         # self.info.setVisible(True)
         # self.threadpool.stackSize(0)
 
-        for i, core in enumerate(self.view.core_list):
-            if self.chosen_plots[1]:
-                worker = Worker(core.make_intensity_raw)
-                worker.signals.finished.connect(self.thread_complete)
-                worker.signals.progress.connect(self.progress_fn)
-                self.threadpool.start(worker)
-                self.threadpool.waitForDone(100000)
-
-            # if self.chosen_plots[2]:
-            #     worker2 = Worker(core.make_intensity_int)
-            #     worker2.signals.finished.connect(self.thread_complete)
-            #     worker2.signals.progress.connect(self.progress_fn)
-            #     self.threadpool.start(worker2)
-
-            if self.chosen_plots[3]:
-                worker3 = Worker(core.make_std_int)
-                worker3.signals.finished.connect(self.thread_complete)
-                worker3.signals.progress.connect(self.progress_fn)
-                self.threadpool.start(worker3)
-
-        # if self.chosen_plots[0]:
-        self.thread_complete()
+        # all graphs of a core are computed in one pass over its data
+        keys = []
+        if self.chosen_plots[1]:
+            keys.append('intensity_raw')
+        # if self.chosen_plots[2]:
+        #     keys.append('intensity_int')
+        if self.chosen_plots[3]:
+            keys.append('std_int')
+
+        # the channels run concurrently, thread_complete shows the views after the last one
+        if len(keys) != 0:
+            self.run_job(
+                'Graphs',
+                [lambda progress_callback, cancel, core=core: core.make_graphs(keys, progress_callback, cancel)
+                 for core in self.view.core_list],
+                self.thread_complete
+            )
+        else:
+            # if self.chosen_plots[0]:
+            self.thread_complete()
+
         self.tabs.setCurrentIndex(1)
         # self.tabs.removeTab(4)
         # self.tabs.insertTab(4, self.ViewTabUI(), 'View')
@@ -1423,10 +1654,14 @@ def excepthook(exc_type, exc_value, exc_tb):
     print(tb)
 
 
-sys.excepthook = excepthook
-app = QApplication(sys.argv)
-app.setFont(QFont('Courier', 8))
+if __name__ == '__main__':
+    # the correlation runs in worker processes, which import this module
+    multiprocessing.freeze_support()
+
+    sys.excepthook = excepthook
+    app = QApplication(sys.argv)
+    app.setFont(QFont('Courier', 8))
 
-window = MainWindow()
-window.show()
-app.exec_()
+    window = MainWindow()
+    window.show()
+    app.exec_()
@@ -1,19 +1,174 @@
-import tools as tl
+import numpy as np
+
 import global_var
 
-class NanoParticle():
-    def __init__(self, np_id, first_frame, positions, positive):
+# status of a NP, the index into the list, shown by its color
+STATUS_COLORS = [
+    global_var.green,
+    global_var.red,
+    global_var.yellow,
+    global_var.blue,
+    global_var.purple,
+    global_var.black
+]
+
+NP_DTYPE = np.dtype([
+    ('id', np.int64),
+    ('x', np.float64),
+    ('y', np.float64),
+    ('first_frame', np.int64),
+    ('last_frame', np.int64),
+    ('sign', np.int8),
+    ('status', np.int8)
+])
+
+
+class NPTable(object):
+    # the NPs stored as one structured array, the per-frame trajectories are kept only for the NPs having one
+    def __init__(self):
+        self.data = np.zeros(64, dtype=NP_DTYPE)
+        self.size = 0
+        self.trajectories = dict()
+        self._index = None
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [NanoParticle(self, i) for i in range(self.size)[key]]
+
+        if not -self.size <= key < self.size:
+            raise IndexError('NP {} out of range'.format(key))
+        return NanoParticle(self, key % self.size)
+
+    def __iter__(self):
+        for i in range(self.size):
+            yield NanoParticle(self, i)
+
+    @property
+    def records(self):
+        return self.data[:self.size]
+
+    def append(self, x, y, first_frame, duration, positive, color, trajectory=None):
+        if self.size == len(self.data):
+            self.data = np.concatenate([self.data, np.zeros(len(self.data), dtype=NP_DTYPE)])
+
+        np_id = self.size
+        self.data[np_id] = (
+            np_id,
+            x,
+            y,
+            first_frame,
+            first_frame + duration,
+            1 if positive else -1,
+            STATUS_COLORS.index(color)
+        )
+        self.size += 1
+        self._index = None
+
+        if trajectory is not None:
+            self.trajectories[np_id] = np.asarray(trajectory)
+
+        return NanoParticle(self, np_id)
+
+    def _build_index(self):
+        # the NPs are grouped by the duration (powers of 2) and sorted by the first frame within the groups,
+        # a group is searched only between f - its longest duration and f
+        records = self.records
+        duration = records['last_frame'] - records['first_frame']
+        bucket = np.log2(np.maximum(duration, 1)).astype(int)
+
+        groups = []
+        for b in np.unique(bucket):
+            ids = np.flatnonzero(bucket == b)
+            ids = ids[np.argsort(records['first_frame'][ids], kind='stable')]
+            groups.append((ids, records['first_frame'][ids], np.max(duration[ids])))
+
+        # NPs without any frame are left out of the counts
+        present = records[duration > 0]
+        self._index = (groups, np.sort(present['first_frame']), np.sort(present['last_frame']))
+
+    def in_frame(self, f):
+        # ids of the NPs present in the frame f
+        if self._index is None:
+            self._build_index()
+
+        found = [np.zeros(0, dtype=int)]
+        for ids, first_frames, max_duration in self._index[0]:
+            candidates = ids[
+                np.searchsorted(first_frames, f - max_duration, side='right'):
+                np.searchsorted(first_frames, f, side='right')
+            ]
+            found.append(candidates[self.data['last_frame'][candidates] > f])
+
+        return np.sort(np.concatenate(found))
+
+    def count(self, start, stop):
+        # number of the NPs present in any frame of [start, stop)
+        if self._index is None:
+            self._build_index()
+
+        _, first_frames, last_frames = self._index
+        return int(np.searchsorted(first_frames, stop) - np.searchsorted(last_frames, start, side='right'))
+
+    def positions(self, ids, f):
+        # [y, x] of the NPs in the frame f
+        positions = np.stack([self.data['y'][ids], self.data['x'][ids]], axis=1)
+        for i, np_id in enumerate(ids if self.trajectories else []):
+            if np_id in self.trajectories:
+                positions[i] = self.trajectories[np_id][f - self.data['first_frame'][np_id]][::-1]
+        return positions
+
+    def colors(self, ids):
+        return [STATUS_COLORS[status] for status in self.data['status'][ids]]
+
+
+class NanoParticle(object):
+    __slots__ = ['table', 'np_id']
+
+    def __init__(self, table, np_id):
+        self.table = table
         self.np_id = np_id
-        self.positions = positions
-        self.first_frame = first_frame
 
-        self.color = tl.random_color()
-        self.positive = positive
-        self.last_frame = first_frame + len(positions)
+    @property
+    def x(self):
+        return self.table.data['x'][self.np_id]
+
+    @property
+    def y(self):
+        return self.table.data['y'][self.np_id]
+
+    @property
+    def first_frame(self):
+        return self.table.data['first_frame'][self.np_id]
+
+    @property
+    def last_frame(self):
+        return self.table.data['last_frame'][self.np_id]
+
+    @property
+    def duration(self):
+        return self.last_frame - self.first_frame
+
+    @property
+    def positive(self):
+        return self.table.data['sign'][self.np_id] > 0
+
+    @property
+    def color(self):
+        return STATUS_COLORS[self.table.data['status'][self.np_id]]
+
+    @color.setter
+    def color(self, color):
+        self.table.data['status'][self.np_id] = STATUS_COLORS.index(color)
 
     def position(self, f):
-        # if f == self.first_frame + len(self.positions)//2:
+        # if f == self.first_frame + self.duration // 2:
         #     self.color = global_var.red
         # else:
         #     self.color = global_var.green
-        return self.positions[f - self.first_frame][::-1]
+        if self.np_id in self.table.trajectories:
+            return self.table.trajectories[self.np_id][f - self.first_frame][::-1]
+
+        return np.array([self.y, self.x])
@@ -1,3 +1,6 @@
+import hashlib
+import types
+
 import numpy as np
 import scipy.signal
 import os
@@ -5,7 +8,7 @@ import random
 from scipy.ndimage import gaussian_filter
 import scipy.optimize as opt
 from global_var import FOLDER_NP_IMAGES
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 
 from scipy import ndimage
 
@@ -26,6 +29,255 @@ def frame_times(file_content):
     return np.array(time_info)
 
 
+def std_time(data, chunk):
+    # per-pixel std along the time axis, merged chunk by chunk (Chan et al.) to keep the memory bounded
+    count = 0
+    mean = np.zeros(data.shape[:2])
+    m2 = np.zeros(data.shape[:2])
+
+    for start in range(0, data.shape[2], chunk):
+        block = np.asarray(data[:, :, start: start + chunk], dtype=np.float64)
+        n = block.shape[2]
+        block_mean = np.mean(block, axis=2)
+        block_m2 = np.sum((block - block_mean[:, :, np.newaxis]) ** 2, axis=2)
+
+        delta = block_mean - mean
+        mean += delta * n / (count + n)
+        m2 += block_m2 + delta ** 2 * count * n / (count + n)
+        count += n
+
+    return np.sqrt(m2 / count)
+
+
+def convert(data, dtype, scale, chunk):
+    # converts the (height, width, time) cube chunk by chunk into a frame-major array of the given type
+    out = np.empty((data.shape[2], data.shape[0], data.shape[1]), dtype=dtype)
+
+    for start in range(0, data.shape[2], chunk):
+        block = np.moveaxis(data[:, :, start: start + chunk], 2, 0)
+        if scale != 1:
+            block = block * scale
+
+        if np.issubdtype(dtype, np.integer):
+            info = np.iinfo(dtype)
+            block = np.clip(np.round(block), info.min, info.max)
+
+        out[start: start + chunk] = block
+
+    return np.moveaxis(out, 0, 2)
+
+
+def save_frame_major(path, data, chunk):
+    # the (height, width, time) cube is stored as (time, height, width), so that every frame is contiguous
+    out = np.lib.format.open_memmap(
+        path + '.tmp',
+        mode='w+',
+        dtype=data.dtype,
+        shape=(data.shape[2], data.shape[0], data.shape[1])
+    )
+
+    for start in range(0, data.shape[2], chunk):
+        out[start: start + chunk] = np.moveaxis(data[:, :, start: start + chunk], 2, 0)
+
+    out.flush()
+    del out
+    os.replace(path + '.tmp', path)
+
+
+def load_frame_major(path, mmap=False):
+    return np.moveaxis(np.load(path, mmap_mode='r' if mmap else None), 0, 2)
+
+
+def function_key(fn):
+    # hash of what a function computes: its code, constants, global names, default arguments and the values of
+    # its closure, nested functions and code objects are hashed recursively
+    h = hashlib.sha1()
+
+    def update(value):
+        if isinstance(value, types.CodeType):
+            h.update(value.co_code)
+            update(value.co_consts)
+            update(value.co_names)
+        elif isinstance(value, types.FunctionType):
+            update(value.__code__)
+            update(value.__defaults__)
+            update(value.__kwdefaults__)
+            update(tuple(cell.cell_contents for cell in value.__closure__ or ()))
+        elif isinstance(value, np.ndarray):
+            h.update(repr((value.dtype, value.shape)).encode())
+            h.update(np.ascontiguousarray(value).tobytes())
+        elif isinstance(value, (tuple, list)):
+            h.update('{}{}'.format(type(value).__name__, len(value)).encode())
+            for item in value:
+                update(item)
+        elif isinstance(value, dict):
+            update(sorted(value.items(), key=repr))
+        else:
+            h.update(repr(value).encode())
+
+    update(fn)
+    return h.hexdigest()
+
+
+def decimation_filter(k, dtype):
+    # the filter of scipy.signal.decimate (IIR, zero phase) and the length of its padding
+    if np.issubdtype(dtype, np.inexact) and dtype != np.float16:
+        dtype = np.dtype(dtype)
+    else:
+        dtype = np.dtype(np.float64)
+
+    sos = scipy.signal.cheby1(8, 0.05, 0.8 / k, output='sos').astype(dtype)
+    return sos, 3 * (2 * len(sos) + 1 - min(np.sum(sos[:, 2] == 0), np.sum(sos[:, 5] == 0)))
+
+
+def decimate_chunks(data, k, chunk, out=None, buffer=None):
+    # scipy.signal.decimate(data, k, axis=2) computed by chunks of frames, the forward pass of the zero-phase
+    # filter over the odd extension of the video is stored to buffer (h, w, t + 2 * edge), the backward pass
+    # keeps every k-th frame only, the filter states are carried over between the chunks
+    # out and buffer may be memory mapped, the video is read chunk by chunk
+    h, w, length = data.shape
+    sos, edge = decimation_filter(k, data.dtype)
+    dtype = sos.dtype
+
+    if length <= edge:
+        raise Exception('At least {} frames are needed for the decimation'.format(edge + 1))
+
+    total = length + 2 * edge
+    zi = scipy.signal.sosfilt_zi(sos).reshape(len(sos), 1, 1, 2)
+
+    def extension(a, b):
+        # frames [a, b) of the odd extension
+        j = np.arange(a, b)
+        frames = np.array(data[:, :, np.clip(np.abs(j - edge), None, 2 * length + edge - 2 - j)], dtype=dtype)
+
+        left = j < edge
+        right = j >= edge + length
+        frames[:, :, left] = 2 * np.array(data[:, :, :1], dtype=dtype) - frames[:, :, left]
+        frames[:, :, right] = 2 * np.array(data[:, :, -1:], dtype=dtype) - frames[:, :, right]
+        return frames
+
+    if buffer is None:
+        buffer = np.zeros((h, w, total), dtype=dtype)
+
+    state = zi * extension(0, 1)
+    for a in range(0, total, chunk):
+        b = min(a + chunk, total)
+        buffer[:, :, a: b], state = scipy.signal.sosfilt(sos, extension(a, b), axis=2, zi=state)
+
+    if out is None:
+        out = np.zeros((h, w, (length + k - 1) // k), dtype=dtype)
+
+    state = zi * np.array(buffer[:, :, -1:])
+    for b in range(total, edge, -chunk):
+        a = max(b - chunk, 0)
+        filtered, state = scipy.signal.sosfilt(sos, buffer[:, :, a: b][:, :, ::-1], axis=2, zi=state)
+
+        # the frame i of the output is the frame edge + i * k of the extension
+        j = np.arange(a, b)
+        keep = (j >= edge) & (j < edge + length) & ((j - edge) % k == 0)
+        out[:, :, (j[keep] - edge) // k] = filtered[:, :, ::-1][:, :, keep]
+
+    return out
+
+
+def block_mean(data, k, axis=-1, chunk=None, out=None):
+    # averages of the blocks of k samples along the axis, the last block may be shorter
+    data = np.moveaxis(data, axis, -1)
+    length = data.shape[-1]
+
+    if out is None:
+        out = np.moveaxis(np.zeros(data.shape[:-1] + ((length + k - 1) // k,)), -1, axis)
+    view = np.moveaxis(out, axis, -1)
+
+    step = length if chunk is None else max(chunk // k, 1) * k
+    for a in range(0, length, step):
+        block = data[..., a: a + step]
+        starts = np.arange(0, block.shape[-1], k)
+        counts = np.diff(np.append(starts, block.shape[-1]))
+        view[..., a // k: a // k + len(starts)] = np.add.reduceat(block, starts, axis=-1, dtype=np.float64) / counts
+
+    return out
+
+
+class ProgressRange(object):
+    # the progress 0 - 100 of a step of a job shown as [start, stop] of the progress of the job
+    def __init__(self, progress_callback, start, stop):
+        self.progress_callback = progress_callback
+        self.start = start
+        self.stop = stop
+
+    def emit(self, value):
+        if self.progress_callback is not None:
+            self.progress_callback.emit(self.start + value * (self.stop - self.start) / 100)
+
+
+def label_chunks(source, start, stop, chunk):
+    # ndimage.label(data, np.ones((3, 3, 3))) and ndimage.find_objects of the frames [start, stop), source(a, b)
+    # returns the binary frames [a, b), the chunks are labeled one by one and the components touching
+    # across the chunk boundaries are joined (union-find)
+    # returns the slices and the voxels (x, y, t) of the components, in the order of ndimage.label
+    parent = []
+    voxels = []
+    previous = None
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for a in range(start, stop, chunk):
+        b = min(a + chunk, stop)
+        labeled, n = ndimage.label(source(a, b), np.ones((3, 3, 3)))
+        offset = len(parent)
+        parent.extend(range(offset, offset + n))
+
+        # np.nonzero goes in the C order, the voxels of every component stay sorted
+        coords = np.nonzero(labeled)
+        ids = labeled[coords] - 1
+        order = np.argsort(ids, kind='stable')
+        for group in np.split(order, np.searchsorted(ids[order], np.arange(1, n))) if n > 0 else []:
+            voxels.append(np.stack([coords[0][group], coords[1][group], coords[2][group] + a], axis=1))
+
+        current = np.where(labeled[:, :, 0] > 0, labeled[:, :, 0] - 1 + offset, -1)
+        if previous is not None:
+            h, w = current.shape
+            for dx in [-1, 0, 1]:
+                for dy in [-1, 0, 1]:
+                    p = previous[max(-dx, 0): h - max(dx, 0), max(-dy, 0): w - max(dy, 0)]
+                    c = current[max(dx, 0): h - max(-dx, 0), max(dy, 0): w - max(-dy, 0)]
+                    touching = (p >= 0) & (c >= 0)
+
+                    for i, j in set(zip(p[touching].tolist(), c[touching].tolist())):
+                        i, j = find(i), find(j)
+                        if i != j:
+                            parent[max(i, j)] = min(i, j)
+
+        previous = np.where(labeled[:, :, -1] > 0, labeled[:, :, -1] - 1 + offset, -1)
+
+    components = dict()
+    for i in range(len(parent)):
+        components.setdefault(find(i), []).append(voxels[i])
+
+    joined = []
+    for parts in components.values():
+        if len(parts) == 1:
+            joined.append(parts[0])
+        else:
+            points = np.concatenate(parts)
+            joined.append(points[np.lexsort(points.T[::-1])])
+
+    # ndimage.label numbers the components by their first voxel in the C order
+    joined.sort(key=lambda points: tuple(points[0]))
+
+    slices = [
+        tuple(slice(int(points[:, i].min()), int(points[:, i].max()) + 1) for i in range(3))
+        for points in joined
+    ]
+
+    return slices, joined
+
+
 def SecToMin(sec):
     return '{:.0f}:{:.1f}'.format(sec // 60, sec % 60)
 
@@ -118,43 +370,67 @@ def before_save_file(path):
     return True
 
 
-def np_analysis(npp, x0, y0, folder, file, image=False):
-    def twoD_Gaussian(xy, amplitude, xo, yo, sigma_x, sigma_y, theta, offset):
-        x, y = xy
-        xo = float(xo)
-        yo = float(yo)
-        a = (np.cos(theta) ** 2) / (2 * sigma_x ** 2) + (np.sin(theta) ** 2) / (2 * sigma_y ** 2)
-        b = -(np.sin(2 * theta)) / (4 * sigma_x ** 2) + (np.sin(2 * theta)) / (4 * sigma_y ** 2)
-        c = (np.sin(theta) ** 2) / (2 * sigma_x ** 2) + (np.cos(theta) ** 2) / (2 * sigma_y ** 2)
-        g = offset + amplitude * np.exp(- (a * ((x - xo) ** 2) + 2 * b * (x - xo) * (y - yo)
-                                           + c * ((y - yo) ** 2)))
-        return g.ravel()
-
+def gaussian_2d(xy, amplitude, xo, yo, sigma_x, sigma_y, theta, offset):
+    x, y = xy
+    xo = float(xo)
+    yo = float(yo)
+    a = (np.cos(theta) ** 2) / (2 * sigma_x ** 2) + (np.sin(theta) ** 2) / (2 * sigma_y ** 2)
+    b = -(np.sin(2 * theta)) / (4 * sigma_x ** 2) + (np.sin(2 * theta)) / (4 * sigma_y ** 2)
+    c = (np.sin(theta) ** 2) / (2 * sigma_x ** 2) + (np.cos(theta) ** 2) / (2 * sigma_y ** 2)
+    g = offset + amplitude * np.exp(- (a * ((x - xo) ** 2) + 2 * b * (x - xo) * (y - yo)
+                                       + c * ((y - yo) ** 2)))
+    return g.ravel()
+
+
+def gaussian_2d_jacobian(xy, amplitude, xo, yo, sigma_x, sigma_y, theta, offset):
+    # derivatives of gaussian_2d by its parameters, one column per parameter
+    x, y = xy
+    dx = (x - xo).ravel()
+    dy = (y - yo).ravel()
+    cos2, sin2 = np.cos(theta) ** 2, np.sin(theta) ** 2
+    sin2t, cos2t = np.sin(2 * theta), np.cos(2 * theta)
+
+    a = cos2 / (2 * sigma_x ** 2) + sin2 / (2 * sigma_y ** 2)
+    b = -sin2t / (4 * sigma_x ** 2) + sin2t / (4 * sigma_y ** 2)
+    c = sin2 / (2 * sigma_x ** 2) + cos2 / (2 * sigma_y ** 2)
+    e = np.exp(-(a * dx ** 2 + 2 * b * dx * dy + c * dy ** 2))
+    ae = amplitude * e
+
+    def d_quadratic(da, db, dc):
+        return -ae * (da * dx ** 2 + 2 * db * dx * dy + dc * dy ** 2)
+
+    return np.stack([
+        e,
+        ae * (2 * a * dx + 2 * b * dy),
+        ae * (2 * b * dx + 2 * c * dy),
+        d_quadratic(-cos2 / sigma_x ** 3, sin2t / (2 * sigma_x ** 3), -sin2 / sigma_x ** 3),
+        d_quadratic(-sin2 / sigma_y ** 3, -sin2t / (2 * sigma_y ** 3), -cos2 / sigma_y ** 3),
+        d_quadratic(
+            -sin2t / (2 * sigma_x ** 2) + sin2t / (2 * sigma_y ** 2),
+            -cos2t / (2 * sigma_x ** 2) + cos2t / (2 * sigma_y ** 2),
+            sin2t / (2 * sigma_x ** 2) - sin2t / (2 * sigma_y ** 2)
+        ),
+        np.ones_like(e)
+    ], axis=1)
+
+
+def np_fit(npp, x0, y0):
+    # fits the NP surroundings by a 2D gaussian, returns the results (or False) and the area of the NP
     # initial_guess = (0.03, x0, y0, 2, 2, 0, 10)
 
-
     initial_guess = (0.03, x0, y0, 2, 2, 0, 0.0001)
-    # initial_guess_xy = (0.03, 2, 2, 0, 10)
 
     x = np.linspace(0, npp.shape[0] - 1, npp.shape[0])
     y = np.linspace(0, npp.shape[1] - 1, npp.shape[1])
     x, y = np.meshgrid(x, y)
 
     try:
-        popt, pcov = opt.curve_fit(twoD_Gaussian, (x, y), np.abs(npp).reshape(npp.shape[0] * npp.shape[1]),
-                                   p0=initial_guess)
-
-        # twoD_Gaussian_xy = lambda xy, amplitude, sigma_x, sigma_y, theta, offset: twoD_Gaussian(xy, amplitude, x0,
-        #                                                                                             y0, sigma_x,
-        #                                                                                             sigma_y, theta,
-        #                                                                                             offset)
-        #
-        # popt, pcov = opt.curve_fit(twoD_Gaussian_xy, (x, y), np.abs(npp).reshape(npp.shape[0] * npp.shape[1]),
-        #                            p0=initial_guess_xy)
+        popt, pcov = opt.curve_fit(gaussian_2d, (x, y), np.abs(npp).reshape(npp.shape[0] * npp.shape[1]),
+                                   p0=initial_guess, jac=gaussian_2d_jacobian)
     except RuntimeError:
-        return False
-    # popt = [popt[0], x0, y0] + [p for p in popt[1:]]
-    data_fitted = twoD_Gaussian((x, y), *popt)
+        return False, None
+
+    data_fitted = gaussian_2d((x, y), *popt)
     lim = np.average(np.abs(npp)) * 4
     perr = np.sqrt(np.diag(pcov))
 
@@ -164,7 +440,6 @@ def np_analysis(npp, x0, y0, folder, file, image=False):
     intensity = np.sum(np.abs(npp)[threshold])
     intensity_bg_px = np.average(np.abs(npp)[threshold == False])
 
-
     try:
         max_intensity = np.max(np.abs(npp)[threshold]) - intensity_bg_px
     except ValueError:
@@ -182,23 +457,35 @@ def np_analysis(npp, x0, y0, folder, file, image=False):
             np.abs(popt[4]) > 15 or \
             popt[0] < 0 or \
             popt[0] < lim:
-        return False
+        return False, None
+
+    return [area, intensity, intensity_px, intensity_bg_px, max_intensity, snr], threshold
+
 
-    if image:
-        fig, ax = plt.subplots(1, 1)
-        ax.imshow(np.abs(npp), cmap='gray', origin='lower')
-        ax.imshow(threshold, cmap='plasma', origin='lower', alpha=0.2)
+def save_np_image(npp, threshold, folder, file):
+    # no pyplot, the figure is not kept by any backend
+    fig = Figure()
+    ax = fig.subplots(1, 1)
+    ax.imshow(np.abs(npp), cmap='gray', origin='lower')
+    ax.imshow(threshold, cmap='plasma', origin='lower', alpha=0.2)
 
-        if not os.path.isdir(folder + FOLDER_NP_IMAGES):
-            os.mkdir(folder + FOLDER_NP_IMAGES)
+    if not os.path.isdir(folder + FOLDER_NP_IMAGES):
+        os.mkdir(folder + FOLDER_NP_IMAGES)
 
-        file_name = folder + FOLDER_NP_IMAGES + '/' + file + '_fit'
+    file_name = folder + FOLDER_NP_IMAGES + '/' + file + '_fit'
 
-        i = 1
-        while os.path.isfile(file_name + '_{:02d}.png'.format(i)):
-            i += 1
+    i = 1
+    while os.path.isfile(file_name + '_{:02d}.png'.format(i)):
+        i += 1
+
+    file_name += '_{:02d}'.format(i)
+    fig.savefig(file_name + '.png', dpi=300, bbox_inches='tight')
+
+
+def np_analysis(npp, x0, y0, folder, file, image=False):
+    result, threshold = np_fit(npp, x0, y0)
 
-        file_name += '_{:02d}'.format(i)
-        fig.savefig(file_name + '.png', dpi=300, bbox_inches='tight')
+    if result is not False and image:
+        save_np_image(npp, threshold, folder, file)
 
-    return [area, intensity, intensity_px, intensity_bg_px, max_intensity, snr]
+    return result
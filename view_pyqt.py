@@ -1,11 +1,14 @@
 import numpy as np
 import os
+import time
 
 import matplotlib
 import matplotlib.font_manager as fm
 import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
+from PyQt5.QtCore import QTimer
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg
+from matplotlib.collections import EllipseCollection
 from matplotlib.backend_bases import key_press_handler
 from matplotlib.widgets import RectangleSelector
 from mpl_toolkits.axes_grid1.anchored_artists import AnchoredSizeBar
@@ -51,11 +54,11 @@ class Canvas(FigureCanvasQTAgg):
         self.mpl_connect('scroll_event', self.mouse_scroll)
 
     def next_frame(self, df):
-        self.view.next_frame(df)
+        self.view.request_frame(df)
 
     def mouse_click_spr(self, event):
         if event.button == 1 and event.inaxes.get_title() != 'Histogram':
-            self.next_frame(int(round(event.xdata)) - self.view.f)
+            self.view.request_frame(f=int(round(event.xdata)))
 
     def mouse_enter(self, event):
         if event.inaxes is not None:
@@ -122,8 +125,10 @@ class Canvas(FigureCanvasQTAgg):
 
         print('File SAVED @{}'.format(name))
 
-    def save_gif(self, start=0, stop=50, speed = 1, gif=True):
-        for axes in self.view.axes:
+    def save_gif(self, start=0, stop=50, speed = 1, gif=True, progress_callback=None):
+        # the frames are computed by the cores, the view is not moved, so it may run off the GUI thread
+        n = len(self.view.axes) * (stop - start)
+        for j, axes in enumerate(self.view.axes):
             if not os.path.isdir(axes.core.folder + FOLDER_EXPORTS):
                 os.mkdir(axes.core.folder + FOLDER_EXPORTS)
 
@@ -131,25 +136,22 @@ class Canvas(FigureCanvasQTAgg):
                 if not os.path.isdir(axes.core.folder + FOLDER_EXPORTS + '/tmp'):
                     os.mkdir(axes.core.folder + FOLDER_EXPORTS + '/tmp')
 
-            self.view.next_frame(- self.view.f)
-            self.view.next_frame(start)
             sequence = []
 
+            img = axes.get_images()[0]
+            xlim = [int(i) for i in axes.get_xlim()]
+            ylim = [int(i) for i in axes.get_ylim()]
+            clim = img.get_clim()
+
             for i in range(stop - start):
                 print('\r\t{}/ {}'.format(i + 1, stop - start), end='')
 
-                self.view.next_frame(1)
-
-                img = axes.get_images()[0]
-                xlim = [int(i) for i in axes.get_xlim()]
-                ylim = [int(i) for i in axes.get_ylim()]
-
-                current = img.get_array()[
+                current = axes.core.frame((start + 1 + i) % self.view.length)[
                           ylim[1]: ylim[0],
                           xlim[0]: xlim[1]
                           ]
 
-                current = (current - img.get_clim()[0]) / (img.get_clim()[1] - img.get_clim()[0]) * 255
+                current = (current - clim[0]) / (clim[1] - clim[0]) * 255
                 current[current > 255] = 255
                 current[current < 0] = 0
 
@@ -165,6 +167,9 @@ class Canvas(FigureCanvasQTAgg):
 
                 sequence.append(pilimage.convert("P"))
 
+                if progress_callback is not None:
+                    progress_callback.emit((j * (stop - start) + i + 1) / n * 100)
+
             print('\n')
 
             name_gif = '{}/gif_{}'.format(
@@ -327,6 +332,8 @@ class Canvas(FigureCanvasQTAgg):
             self.draw()
 
     def set_range(self, axes):
+        self.view._backgrounds.pop(self, None)
+
         img = axes.get_images()[0]
         img.set_clim(axes.core.range)
         for txt, c in zip(self.view.text, self.view.core_list):
@@ -335,6 +342,10 @@ class Canvas(FigureCanvasQTAgg):
     def button_press(self, event):
         key_press_handler(event, self, self.toolbar)
 
+        # the navigation and the playback redraw only the changed artists (blit), the figure is drawn after a
+        # change of the type, range, reference or filters
+        redraw = False
+
         if event.key == '9':
             # self.next_frame(self.view.core_list[0].k * 10)
             self.next_frame(100)
@@ -356,6 +367,13 @@ class Canvas(FigureCanvasQTAgg):
         elif event.key == 'f':
             self.main_window.filters_checkbox.click()
             self.main_window.filter_threshold_checkbox.click()
+            redraw = True
+        elif event.key == ' ':
+            self.view.playback.toggle()
+        elif event.key == '+':
+            self.view.playback.set_speed(self.view.playback.speed * 2)
+        elif event.key == '-':
+            self.view.playback.set_speed(self.view.playback.speed / 2)
 
         if event.canvas.figure is self.view.fig and event.inaxes is not None:
             core_list = [event.inaxes.core]
@@ -365,6 +383,7 @@ class Canvas(FigureCanvasQTAgg):
                 self.save_frame(event.inaxes)
             elif event.key == 'd':
                 self.view.core_list[0].defects_removal()
+                redraw = True
 
         else:
             core_list = self.view.core_list
@@ -376,69 +395,164 @@ class Canvas(FigureCanvasQTAgg):
                 core.range = [i * 1.2 for i in core.range]
                 # print('core: {}, range: {}'.format(core.file, core.range))
                 self.set_range(axes)
+                redraw = True
 
             elif event.key == '8':
                 core.range = [i / 1.2 for i in core.range]
                 # print('core: {}, range: {}'.format(core.file, core.range))
                 self.set_range(axes)
+                redraw = True
 
             elif event.key == 'ctrl+1':
                 self.view.change_type(axes, 'raw')
                 self.set_range(axes)
+                redraw = True
                 self.next_frame(0)
 
             elif event.key == 'ctrl+2':
                 self.view.change_type(axes, 'int')
                 self.set_range(axes)
+                redraw = True
                 self.next_frame(0)
 
             elif event.key == 'ctrl+3':
                 self.view.change_type(axes, 'diff')
                 self.set_range(axes)
+                redraw = True
                 self.next_frame(0)
 
             elif event.key == 'ctrl+5':
                 self.view.change_type(axes, 'diff')
                 self.set_range(axes)
+                redraw = True
                 self.next_frame(0)
                 self.main_window.filters_checkbox.click()
 
             elif event.key == 'ctrl+6':
                 self.view.change_type(axes, 'corr')
                 self.set_range(axes)
+                redraw = True
                 self.next_frame(0)
                 self.main_window.filters_checkbox.click()
 
             elif event.key == 'alt+1':
                 self.view.change_type(axes, 'four_r')
                 self.set_range(axes)
+                redraw = True
                 self.next_frame(0)
 
             elif event.key == 'alt+2':
                 self.view.change_type(axes, 'four_i')
                 self.set_range(axes)
+                redraw = True
                 self.next_frame(0)
 
             elif event.key == 'alt+3':
                 self.view.change_type(axes, 'four_d')
                 self.set_range(axes)
+                redraw = True
                 self.next_frame(0)
 
             elif event.key == 'alt+4':
                 self.view.change_type(axes, 'mask')
                 self.set_range(axes)
+                redraw = True
                 self.next_frame(0)
 
             elif event.key == 'ctrl+4':
                 self.view.change_type(axes, 'corr')
                 self.set_range(axes)
+                redraw = True
                 self.next_frame(0)
 
             elif event.key == 'i':
                 core.ref_frame = self.view.f
                 self.next_frame(0)
+                redraw = True
 
-        self.draw()
+        if redraw:
+            self.draw()
+
+
+class Playback(object):
+    # plays the video in real time (_time_info) times the speed, the frames are computed ahead by the prefetch
+    # threads of the cores, the display shows the latest frame ready and skips the others
+    def __init__(self, view):
+        self.view = view
+        self.speed = PLAYBACK_SPEED
+        self.timer = QTimer()
+        self.timer.timeout.connect(self.tick)
+
+        self.anchor = None
+        self.shown = 0
+        self.dropped = 0
+        self.time_start = None
+
+    @property
+    def playing(self):
+        return self.timer.isActive()
+
+    @property
+    def fps(self):
+        if self.time_start is None or time.time() == self.time_start:
+            return 0
+        return self.shown / (time.time() - self.time_start)
+
+    def toggle(self):
+        if self.playing:
+            self.timer.stop()
+            self.view.next_frame(0)
+            return
+
+        self.anchor = None
+        self.shown = 0
+        self.dropped = 0
+        self.time_start = time.time()
+
+        self.timer.start(self.interval())
+
+    def set_speed(self, speed):
+        self.speed = speed
+        if self.playing:
+            self.timer.setInterval(self.interval())
+
+    def interval(self):
+        # one tick per frame of the video, at most PLAYBACK_FPS ticks per second [ms]
+        dt = np.median(self.view.core_list[0]._time_info[:, 1])
+        return int(max(dt / self.speed, 1 / PLAYBACK_FPS) * 1000)
+
+    def tick(self):
+        view = self.view
+        times = view.core_list[0]._time_info[:view.length, 0]
+
+        # the playback continues from the shown frame, also after a manual step or a change of the speed
+        if self.anchor is None or self.anchor[2] != view.f or self.anchor[3] != self.speed:
+            self.anchor = [time.time(), times[view.f], view.f, self.speed]
+
+        elapsed = (time.time() - self.anchor[0]) * self.speed
+        target = int(np.searchsorted(times, self.anchor[1] + elapsed, side='right')) - 1
+
+        if target >= view.length - 1:
+            target = view.length - 1
+
+        # frames expected at the next ticks
+        step = max(self.timer.interval() / 1000 * self.speed / np.median(view.core_list[0]._time_info[:, 1]), 1)
+        for core in view.core_list:
+            core.prefetch([int(target + step * i) % view.length for i in range(1, PLAYBACK_AHEAD + 1)])
+
+        f = target
+        while f > view.f and not all(core.frame_ready(f) for core in view.core_list):
+            f -= 1
+
+        if f > view.f:
+            self.dropped += f - view.f - 1
+            self.shown += 1
+            view.next_frame(f - view.f)
+            self.anchor[2] = view.f
+
+        elif target == view.length - 1 and view.f == target:
+            # from the beginning
+            view.next_frame(-view.f)
 
 
 class View(object):
@@ -461,8 +575,18 @@ class View(object):
         self.idea3d = None
 
         self.img_shown = []
+        self.np_markers = []
+        self.playback = Playback(self)
+
+        # the frame requested by the navigation events not shown yet
+        self._requested_f = None
+        self.title = None
         self.canvas_img = None
         self.canvas_plot = None
+
+        # static parts of the figures (axes, ticks, scalebars, ...) rendered by the last full draw, the frame
+        # changes only redraw the animated artists over them
+        self._backgrounds = dict()
         self.plots = [
             {
                 'key': 'spr_signal',
@@ -496,13 +620,35 @@ class View(object):
         if self.length > len(core) or self.length == 0:
             self.length = len(core)
 
+    def request_frame(self, df=0, f=None):
+        # the navigation events are coalesced, the frame is computed once after the queued events are processed,
+        # df: a step from the requested frame, f: a jump to the frame f
+        if self._requested_f is None:
+            self._requested_f = self.f
+            QTimer.singleShot(0, self._show_requested_frame)
+
+        if f is not None:
+            self._requested_f = f
+
+        self._requested_f = (self._requested_f + df) % self.length
+
+    def _show_requested_frame(self):
+        target = self._requested_f
+        self._requested_f = None
+
+        # the frames predicted for the superseded requests are not needed
+        for core in self.core_list:
+            core.cancel_prefetch(keep=[target])
+
+        self.next_frame(target - self.f)
+
     def next_frame(self, df):
         self.f = df
         for location in self.locations:
             y = location.get_y()
             location.xy = [self.f, y]
 
-        self.fig.suptitle(self.frame_info())
+        self.title.set_text(self.frame_info())
 
         for i, core in enumerate(self.core_list):
             self.img_shown[i].set_array(core.frame(self.f))
@@ -529,23 +675,52 @@ class View(object):
             if core.show_nps:
                 positions, colors = core.frame_np(self.f)
 
-                [p.remove() for p in reversed(self.axes[i].patches)]
-
-                for (p, c) in zip(reversed(positions), reversed(colors)):
-                    circle = mpatches.Circle(
-                        p,
-                        5,
-                        color=c,
-                        fill=False,
-                        alpha=0.7,
-                        lw=2)
-                    self.axes[i].add_patch(circle)
+                # the first NPs are drawn on top
+                self.np_markers[i].set_offsets(positions[::-1])
+                self.np_markers[i].set_edgecolors(colors[::-1])
 
-        self.canvas_img.draw()
+        self.blit(self.canvas_img)
         if self.canvas_plot is not None:
-            self.canvas_plot.draw()
+            # the histogram is rebuilt in every frame
+            if self.chosen_plot_indices is not None and 2 in self.chosen_plot_indices:
+                self.canvas_plot.draw()
+            else:
+                self.blit(self.canvas_plot)
 
         self.main_window.RefreshNPInfo()
+        self.prefetch(df)
+
+    def animated_artists(self, canvas):
+        if canvas is self.canvas_img:
+            return self.img_shown + [self.title] + self.np_markers
+
+        return [location for location in self.locations if location.figure is canvas.figure]
+
+    def on_draw(self, event):
+        # after a full draw (resize, new type, range, ...) the background is cached again
+        canvas = event.canvas
+        self._backgrounds[canvas] = canvas.copy_from_bbox(canvas.figure.bbox)
+
+        for artist in self.animated_artists(canvas):
+            canvas.figure.draw_artist(artist)
+
+    def blit(self, canvas):
+        if canvas not in self._backgrounds:
+            canvas.draw()
+            return
+
+        canvas.restore_region(self._backgrounds[canvas])
+        for artist in self.animated_artists(canvas):
+            canvas.figure.draw_artist(artist)
+        canvas.blit(canvas.figure.bbox)
+
+    def prefetch(self, df):
+        # predicts the next frames from the step of the key bindings (1, 10, 100)
+        if abs(df) not in [1, 10, 100]:
+            return
+
+        for core in self.core_list:
+            core.prefetch([(self.f + df * i) % self.length for i in range(1, PREFETCH_FRAMES + 1)])
 
     @property
     def f(self):
@@ -556,7 +731,7 @@ class View(object):
         self._f = (self._f + df) % self.length
 
     def frame_info(self):
-        return '{}/{} |  t = {:.1f} s | dt = {:.2f} s | global time = {:.1f} min'.format(
+        info = '{}/{} |  t = {:.1f} s | dt = {:.2f} s | global time = {:.1f} min'.format(
             self.f,
             self.length,
             self.core_list[0]._time_info[self.f, 0],
@@ -564,7 +739,15 @@ class View(object):
             self.core_list[0]._time_info[self.f, 0] / 60 + self.core_list[0].zero_time
         )
 
+        if self.playback.playing:
+            info += ' | x{:g} | {:.1f} fps | skipped {}'.format(self.playback.speed, self.playback.fps, self.playback.dropped)
+
+        return info
+
     def change_type(self, axes, itype):
+        # the labels are not animated, the next frame is drawn in full
+        self._backgrounds.pop(self.canvas_img, None)
+
         if axes is not None:
             axes.core.type = itype
 
@@ -584,9 +767,12 @@ class View(object):
 
     def mouse_click_spr(self, event):
         if event.button == 1:
-            self.next_frame(int(round(event.xdata)) - self.f)
+            self.request_frame(f=int(round(event.xdata)))
 
     def set_range(self):
+        # the range labels are not animated, the next frame is drawn in full
+        self._backgrounds.pop(self.canvas_img, None)
+
         for axes in self.axes:
             img = axes.get_images()[0]
             img.set_clim(axes.core.range)
@@ -605,7 +791,7 @@ class View(object):
             else:
                 self.fig, self.axes = plt.subplots(nrows=len(self.core_list), ncols=1)
 
-        self.fig.suptitle(self.frame_info())
+        self.title = self.fig.suptitle(self.frame_info(), animated=True)
 
         for i, core in enumerate(self.core_list):
             self.img_shown.append(
@@ -614,12 +800,30 @@ class View(object):
                     cmap='gray',
                     zorder=0,
                     vmin=core.range[0],
-                    vmax=core.range[1]
+                    vmax=core.range[1],
+                    animated=True
                 )
             )
             self.axes[i].core = core
             self.axes[i].toggle_selector = None
 
+            # circles of the NPs in the current frame, r = 5 px
+            self.np_markers.append(
+                EllipseCollection(
+                    10,
+                    10,
+                    0,
+                    units='xy',
+                    offsets=np.zeros((0, 2)),
+                    offset_transform=self.axes[i].transData,
+                    facecolors='none',
+                    linewidths=2,
+                    alpha=0.7,
+                    animated=True
+                )
+            )
+            self.axes[i].add_collection(self.np_markers[i], autolim=False)
+
             fontprops = fm.FontProperties(size=20)
             # show_scalebar = AnchoredSizeBar(self.axes[i].transData,
             #                                 34, '100 $\mu m$', 'lower right',
@@ -664,6 +868,7 @@ class View(object):
                 self.axes[i].spines[s].set_linewidth(2)
 
         self.canvas_img = Canvas(self)
+        self.canvas_img.mpl_connect('draw_event', self.on_draw)
         return self.canvas_img
 
     def show_plots(self, chosen_plots):
@@ -676,12 +881,13 @@ class View(object):
                 (self.f, ax.get_ylim()[0]),
                 1,
                 rectangle_height,
-                color=gray
+                color=gray,
+                animated=True
             )
             self.locations.append(location)
             ax.add_patch(location)
 
-        if self.core_list[0].np_container != []:
+        if len(self.core_list[0].np_container) != 0:
             chosen_plots[3] = True
 
         self.chosen_plot_indices = [i for i in range(len(chosen_plots)) if chosen_plots[i]]
@@ -868,6 +1074,8 @@ class View(object):
         #     )
         # add_time_bar(self.axes_info[1, 1])
 
+        self._backgrounds.pop(self.canvas_plot, None)
         self.canvas_plot = Canvas(self, False)
+        self.canvas_plot.mpl_connect('draw_event', self.on_draw)
 
         return self.canvas_plot